@@ -0,0 +1,161 @@
+import csv
+import io
+from datetime import datetime
+from decimal import Decimal
+
+
+class SalesRollups:
+    # Daily totals kept next to the orders so reports read O(days) rows instead of every order:
+    #   DailySales:        (day, status) -> orders, revenue
+    #   DailyProductSales: (day, product_id) -> units, revenue
+    # record_order/record_payment run inside the checkout/payment transaction; rebuild() recomputes
+    # a range of days from orders/order_lines, for existing data or to repair drift.
+    # Brand and category reports join the product rollup with the current catalog.
+
+    def __init__(self, db, Order, OrderLine, Product, Brand, Category, DailySales, DailyProductSales):
+        self.db = db
+        self.Order = Order
+        self.OrderLine = OrderLine
+        self.Product = Product
+        self.Brand = Brand
+        self.Category = Category
+        self.DailySales = DailySales
+        self.DailyProductSales = DailyProductSales
+
+    def _upsert(self, model, keys, rows):
+        # insert rows, or add their counters to the ones already there
+        counters = [column.name for column in model.__table__.columns if column.name not in keys]
+        dialect = self.db.engine.dialect.name
+        if dialect in ("sqlite", "postgresql"):
+            if dialect == "sqlite":
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            statement = insert(model).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=keys,
+                set_={name: getattr(model, name) + getattr(statement.excluded, name) for name in counters})
+            self.db.session.execute(statement)
+            return
+        for row in rows:
+            result = self.db.session.execute(
+                self.db.update(model)
+                .where(*[getattr(model, key) == row[key] for key in keys])
+                .values({name: getattr(model, name) + row[name] for name in counters}))
+            if result.rowcount == 0:
+                self.db.session.execute(self.db.insert(model), [row])
+
+    def record_order(self, order):
+        day = (order.date_created or datetime.utcnow()).date()
+        self._upsert(self.DailySales, ("day", "status"),
+                     [{"day": day, "status": order.status or "pending", "orders": 1, "revenue": order.total}])
+        products = {}
+        for line in order.lines:
+            units, revenue = products.get(line.product_id, (0, Decimal(0)))
+            products[line.product_id] = (units + line.quantity, revenue + line.line_total)
+        if products:
+            self._upsert(self.DailyProductSales, ("day", "product_id"),
+                         [{"day": day, "product_id": product_id, "units": units, "revenue": revenue}
+                          for product_id, (units, revenue) in products.items()])
+
+    def record_payment(self, order, old_status="pending"):
+        # moves the order from its old status bucket to "paid" on the day it was placed
+        if order.total is None:
+            return  # placed before totals were stored; counted once rebuild() has run after the backfill
+        day = order.date_created.date()
+        self._upsert(self.DailySales, ("day", "status"), [
+            {"day": day, "status": old_status, "orders": -1, "revenue": -order.total},
+            {"day": day, "status": order.status, "orders": 1, "revenue": order.total}])
+
+    def _day(self, column):
+        # sqlite keeps dates as 'YYYY-MM-DD' text, which is what date() returns
+        if self.db.engine.dialect.name == "sqlite":
+            return self.db.func.date(column)
+        return self.db.cast(column, self.db.Date)
+
+    def rebuild(self, since=None):
+        db, Order, OrderLine = self.db, self.Order, self.OrderLine
+        day = self._day(Order.date_created)
+        for model in (self.DailySales, self.DailyProductSales):
+            statement = db.delete(model)
+            if since is not None:
+                statement = statement.where(model.day >= since)
+            db.session.execute(statement)
+
+        orders = (db.select(day, Order.status, db.func.count(), db.func.sum(Order.total))
+                  .where(Order.total.is_not(None)).group_by(day, Order.status))
+        lines = (db.select(day, OrderLine.product_id, db.func.sum(OrderLine.quantity), db.func.sum(OrderLine.line_total))
+                 .join(Order, Order.id == OrderLine.order_id).group_by(day, OrderLine.product_id))
+        if since is not None:
+            orders = orders.where(Order.date_created >= since)
+            lines = lines.where(Order.date_created >= since)
+        db.session.execute(db.insert(self.DailySales).from_select(["day", "status", "orders", "revenue"], orders))
+        db.session.execute(db.insert(self.DailyProductSales).from_select(["day", "product_id", "units", "revenue"], lines))
+        db.session.commit()
+
+    # reports; start/end are inclusive dates
+
+    def _between(self, statement, model, start, end):
+        if start is not None:
+            statement = statement.where(model.day >= start)
+        if end is not None:
+            statement = statement.where(model.day <= end)
+        return statement
+
+    def daily(self, start=None, end=None):
+        DailySales = self.DailySales
+        paid = DailySales.status == "paid"
+        sum_if = lambda condition, column: self.db.func.coalesce(self.db.func.sum(self.db.case((condition, column))), 0)
+        statement = (self.db.select(DailySales.day,
+                                    sum_if(paid, DailySales.orders).label("paid_orders"),
+                                    sum_if(paid, DailySales.revenue).label("paid_revenue"),
+                                    sum_if(~paid, DailySales.orders).label("pending_orders"),
+                                    sum_if(~paid, DailySales.revenue).label("pending_revenue"))
+                     .group_by(DailySales.day).order_by(DailySales.day))
+        return self._between(statement, DailySales, start, end)
+
+    def by_status(self, start=None, end=None):
+        DailySales = self.DailySales
+        statement = (self.db.select(DailySales.status, self.db.func.sum(DailySales.orders).label("orders"),
+                                    self.db.func.sum(DailySales.revenue).label("revenue"))
+                     .group_by(DailySales.status).order_by(DailySales.status))
+        return self._between(statement, DailySales, start, end)
+
+    def _grouped(self, columns, join, start, end, limit):
+        DailyProductSales = self.DailyProductSales
+        units = self.db.func.sum(DailyProductSales.units).label("units")
+        statement = (self.db.select(*columns, units, self.db.func.sum(DailyProductSales.revenue).label("revenue"))
+                     .select_from(DailyProductSales).outerjoin(self.Product, self.Product.id == DailyProductSales.product_id))
+        if join is not None:
+            statement = statement.outerjoin(*join)
+        statement = statement.group_by(*columns).order_by(units.desc())
+        if limit:
+            statement = statement.limit(limit)
+        return self._between(statement, DailyProductSales, start, end)
+
+    def by_product(self, start=None, end=None, limit=None):
+        return self._grouped((self.DailyProductSales.product_id, self.Product.name), None, start, end, limit)
+
+    def by_brand(self, start=None, end=None, limit=None):
+        return self._grouped((self.Brand.id, self.Brand.name), (self.Brand, self.Brand.id == self.Product.brand_id),
+                             start, end, limit)
+
+    def by_category(self, start=None, end=None, limit=None):
+        return self._grouped((self.Category.id, self.Category.name),
+                             (self.Category, self.Category.id == self.Product.category_id), start, end, limit)
+
+    def rows(self, statement):
+        return self.db.session.execute(statement).all()
+
+    def csv_lines(self, statement):
+        # one csv line per row as the database returns them, so an export never sits in memory whole
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        result = self.db.session.execute(statement.execution_options(yield_per=500))
+        writer.writerow(result.keys())
+        for row in result:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
@@ -0,0 +1,85 @@
+# Bytes on the wire for one "home" page view, with plain static files and with the fingerprinted,
+# precompressed build from "flask build-assets".
+#
+# A first view fetches the page and every /static file it links. A repeat view fetches the page again and
+# only those files the browser is not allowed to reuse without asking (no immutable max-age); each of those
+# costs a revalidation round trip even when it comes back 304.
+#
+#   python benchmarks/asset_bench.py [--products 40]
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from storefront_bench import load_app, seed
+
+STATIC_URL = re.compile(r'(?:href|src|data-full)="(/static/[^"]+)"')
+BROWSER = {"Accept-Encoding": "br, gzip, deflate"}
+
+
+def cached_without_asking(response):
+    cache_control = response.cache_control
+    return bool(cache_control.immutable and cache_control.max_age)
+
+
+def page_view(client):
+    page = client.get("/home", headers=BROWSER)
+    urls = sorted(set(STATIC_URL.findall(page.get_data(as_text=True))))
+    first = {"requests": 1, "bytes": len(page.data)}
+    repeat = {"requests": 1, "bytes": len(page.data)}
+    for url in urls:
+        response = client.get(url, headers=BROWSER)
+        size = len(response.get_data())
+        response.close()
+        first["requests"] += 1
+        first["bytes"] += size
+        if not cached_without_asking(response):
+            repeat["requests"] += 1  # a conditional GET answered with an empty 304
+    return urls, first, repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes transferred for a home page view.")
+    parser.add_argument("--products", type=int, default=40)
+    args = parser.parse_args()
+
+    main_module, app = load_app("sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="assetbench-"), "bench.db"))
+    with app.app_context():
+        seed(main_module, 5, 5, args.products, 1, 0)
+    client = app.test_client()
+    client.post("/", data={"email": "bench1@example.com", "password": "benchmark-password"})
+
+    static_folder = app.static_folder
+    dist = os.path.join(static_folder, "dist")
+    backup = None
+    if os.path.exists(dist):
+        backup = tempfile.mkdtemp(prefix="dist-")
+        shutil.move(dist, os.path.join(backup, "dist"))
+    try:
+        main_module.assets.load()  # no build: plain files
+        urls_before, first_before, repeat_before = page_view(client)
+        main_module.static_assets.build(static_folder)
+        main_module.assets.load()
+        urls_after, first_after, repeat_after = page_view(client)
+    finally:
+        shutil.rmtree(dist, ignore_errors=True)
+        if backup:
+            shutil.move(os.path.join(backup, "dist"), dist)
+        main_module.assets.load()
+
+    print("%-22s %10s %10s %12s %12s" % ("", "requests", "bytes", "repeat reqs", "repeat bytes"))
+    print("%-22s %10d %10d %12d %12d" % ("plain static files", first_before["requests"], first_before["bytes"],
+                                         repeat_before["requests"], repeat_before["bytes"]))
+    print("%-22s %10d %10d %12d %12d" % ("fingerprinted build", first_after["requests"], first_after["bytes"],
+                                         repeat_after["requests"], repeat_after["bytes"]))
+    for before, after in zip(urls_before, urls_after):
+        if before != after:
+            print("  %s -> %s" % (before, after))
+
+
+if __name__ == "__main__":
+    main()
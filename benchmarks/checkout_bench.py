@@ -0,0 +1,91 @@
+# Checkout contention: --buyers customers put the same product in their carts and all press "checkout" at
+# once, against --stock units. Exactly min(stock, buyers * quantity) units may be sold; the script reports
+# how many orders went through, how many were turned away, how long the burst took, and exits 1 on an
+# oversell (more units sold than there were, or stock below zero).
+#
+#   python benchmarks/checkout_bench.py --buyers 30 --stock 10 --rounds 5
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from storefront_bench import PASSWORD, load_app, percentile, seed
+
+
+def buyer(app, number, product_id, quantity):
+    client = app.test_client()
+    client.environ_base["REMOTE_ADDR"] = "10.2.%d.%d" % (number // 250, number % 250 + 1)
+    response = client.post("/", data={"email": "bench%d@example.com" % number, "password": PASSWORD})
+    if "/home" not in response.headers.get("Location", ""):
+        raise RuntimeError("login failed for bench%d" % number)
+    client.post("/add-to-cart", data={"product_id": str(product_id), "quantity": str(quantity), "color": "red"})
+    return client
+
+
+def burst(app, clients):
+    # every buyer waits at the barrier, then checks out; returns the redirect targets and the wall time
+    barrier = threading.Barrier(len(clients))
+    results = [None] * len(clients)
+
+    def checkout(index, client):
+        barrier.wait()
+        started = time.perf_counter()
+        response = client.get("/checkout")
+        response.close()
+        results[index] = (response.headers.get("Location", str(response.status_code)), time.perf_counter() - started)
+
+    threads = [threading.Thread(target=checkout, args=(index, client)) for index, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent checkouts of one product; exit 1 on oversell.")
+    parser.add_argument("--buyers", type=int, default=30, help="customers checking out at the same time")
+    parser.add_argument("--stock", type=int, default=10, help="units of the product on hand for each round")
+    parser.add_argument("--quantity", type=int, default=1, help="units in each cart")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--db", help="database URI (default: a throwaway SQLite file)")
+    args = parser.parse_args()
+
+    db_uri = args.db or "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="checkoutbench-"), "bench.db")
+    main_module, app = load_app(db_uri)
+    db, Product, Order = main_module.db, main_module.Product, main_module.Order
+    with app.app_context():
+        seed(main_module, 1, 1, 1, args.buyers, 0)
+
+    oversold = False
+    print("%5s %6s %6s %8s %8s %10s %10s" % ("round", "stock", "orders", "sold", "left", "p50", "p95"))
+    for number in range(1, args.rounds + 1):
+        with app.app_context():
+            db.session.execute(db.update(Product).values(stock=args.stock))
+            db.session.commit()
+            orders_before = db.session.execute(db.select(db.func.count()).select_from(Order)).scalar()
+        clients = [buyer(app, index, 1, args.quantity) for index in range(1, args.buyers + 1)]
+        results = burst(app, clients)
+        with app.app_context():
+            left = db.session.execute(db.select(Product.stock).where(Product.id == 1)).scalar()
+            orders = db.session.execute(db.select(db.func.count()).select_from(Order)).scalar() - orders_before
+        placed = sum(1 for location, _ in results if "invoice:" in location)
+        sold = placed * args.quantity
+        expected = min(args.stock, args.buyers * args.quantity) // args.quantity * args.quantity
+        timings = [elapsed for _, elapsed in results]
+        print("%5d %6d %6d %8d %8d %8.1fms %8.1fms" % (number, args.stock, placed, sold, left,
+                                                      percentile(timings, 50) * 1000, percentile(timings, 95) * 1000))
+        if left < 0 or sold > args.stock or orders != placed or sold + left != args.stock:
+            print("OVERSELL: %d units sold and %d left from %d, %d orders recorded" % (sold, left, args.stock, orders))
+            oversold = True
+        elif sold != expected:
+            print("note: %d units sold, %d could have been" % (sold, expected))
+    sys.exit(1 if oversold else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Login throughput under contention, and what a login burst does to browsing on the same worker.
+#
+# For each hashing mode, --logins threads log in as fast as they can (each from its own address, so the
+# throttle stays out of the way) while --browsers threads keep loading /home. "inline" hashes on the request
+# thread, as the app used to; "pool" uses the bounded process pool (HASH_WORKERS / HASH_QUEUE).
+# A last run replays a credential-stuffing burst (one address, many accounts, wrong passwords) against the
+# throttle and counts how many attempts were turned away before any hashing.
+#
+#   python benchmarks/login_bench.py --logins 8 --browsers 4 --duration 10 --hash-workers 1 --queue 4
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from storefront_bench import PASSWORD, load_app, percentile, seed
+
+
+def drive(main, app, args, hasher):
+    main.password_hasher = hasher  # login()/register() look it up at call time
+    statuses = {}
+    browse = []
+    lock = threading.Lock()
+
+    def login(number):
+        client = app.test_client()
+        email = "bench%d@example.com" % (number % args.users + 1)
+        while time.perf_counter() < stop:
+            response = client.post("/", data={"email": email, "password": PASSWORD},
+                                   environ_base={"REMOTE_ADDR": "10.0.%d.%d" % (number // 250, number % 250 + 1)})
+            response.close()
+            key = "ok" if response.status_code == 302 else str(response.status_code)
+            with lock:
+                statuses[key] = statuses.get(key, 0) + 1
+
+    def browser(client):
+        local = []
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            response = client.get("/home")
+            response.close()
+            local.append(time.perf_counter() - started)
+        with lock:
+            browse.extend(local)
+
+    browsers = []
+    for number in range(args.browsers):
+        client = app.test_client()
+        client.post("/", data={"email": "bench%d@example.com" % (number + 1), "password": PASSWORD},
+                    environ_base={"REMOTE_ADDR": "10.1.0.%d" % (number + 1)})
+        browsers.append(client)
+    stop = time.perf_counter() + args.duration
+    threads = [threading.Thread(target=login, args=(number,)) for number in range(args.logins)]
+    threads += [threading.Thread(target=browser, args=(client,)) for client in browsers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses, browse
+
+
+def stuffing(main, app, args):
+    # one address, a different account each time, always the wrong password
+    client = app.test_client()
+    counts = {}
+    started = time.perf_counter()
+    for attempt in range(args.stuffing):
+        response = client.post("/", data={"email": "bench%d@example.com" % (attempt % args.users + 1),
+                                          "password": "guess-%d" % attempt}, environ_base={"REMOTE_ADDR": "203.0.113.7"})
+        response.close()
+        counts[response.status_code] = counts.get(response.status_code, 0) + 1
+    return counts, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login throughput and browse latency under a login burst.")
+    parser.add_argument("--logins", type=int, default=8, help="threads logging in")
+    parser.add_argument("--browsers", type=int, default=4, help="threads loading /home meanwhile")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per mode")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--method", default="scrypt:32768:8:1", help="PASSWORD_HASH_METHOD")
+    parser.add_argument("--hash-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--queue", type=int, default=4, help="HASH_QUEUE")
+    parser.add_argument("--stuffing", type=int, default=200, help="attempts in the credential-stuffing run")
+    args = parser.parse_args()
+
+    os.environ["PASSWORD_HASH_METHOD"] = args.method
+    main_module, app = load_app("sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="loginbench-"), "bench.db"))
+    with app.app_context():
+        seed(main_module, 2, 2, 50, max(args.users, args.browsers), 0)
+    from passwords import LoginThrottle, PasswordHasher
+
+    default_throttle = main_module.login_throttle
+    main_module.login_throttle = LoginThrottle(per_ip=10 ** 9, per_account=10 ** 9)
+    modes = (("inline", PasswordHasher(args.method, max_workers=0)),
+             ("pool", PasswordHasher(args.method, max_workers=args.hash_workers, max_pending=args.queue)))
+    print("%-8s %9s %9s %9s %9s %12s %12s" % ("mode", "logins/s", "503s", "other", "browse/s", "browse p50", "browse p95"))
+    for name, hasher in modes:
+        if hasher.max_workers:
+            hasher.hash("warm up")  # start the pool's processes outside the measurement
+        statuses, browse = drive(main_module, app, args, hasher)
+        other = sum(count for key, count in statuses.items() if key not in ("ok", "503"))
+        print("%-8s %9.1f %9d %9d %9.1f %10.1fms %10.1fms" % (
+            name, statuses.get("ok", 0) / args.duration, statuses.get("503", 0), other, len(browse) / args.duration,
+            percentile(browse, 50) * 1000, percentile(browse, 95) * 1000))
+
+    main_module.login_throttle = default_throttle
+    counts, elapsed = stuffing(main_module, app, args)
+    print("stuffing: %d attempts from one address in %.1fs -> %s (limit %d per %ds)" % (
+        args.stuffing, elapsed, ", ".join("%d x %d" % (count, status) for status, count in sorted(counts.items())),
+        default_throttle.per_ip, default_throttle.window))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+# Compares pricing.price_items with the per-line loop that cart_items/order_details/order_details_as_pdf used to run.
+#   python benchmarks/pricing_bench.py [lines ...]
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pricing import price_items
+
+
+def old_loop(items):
+    subtotal = 0
+    for key, value in items.items():
+        rate = int(value["discount"]) / 100
+        discount = (float(value["price"]) * int(value["quantity"])) * rate
+        subtotal += (float(value["price"]) * int(value["quantity"])) - discount
+        tax = "%.2f" % (.05 * subtotal)
+        total = "%.2f" % (1.05 * subtotal)
+    return subtotal, float(tax), total
+
+
+def make_cart(lines):
+    rnd = random.Random(lines)
+    return {str(i): {"name": "Product %d" % i, "price": "%d.%02d" % (rnd.randint(1, 500), rnd.randint(0, 99)),
+                     "discount": rnd.choice([0, 5, 10, 25]), "quantity": str(rnd.randint(1, 5)), "color": "red"}
+            for i in range(1, lines + 1)}
+
+
+def main(sizes):
+    print("%8s %14s %14s" % ("lines", "old loop (us)", "pricing (us)"))
+    for lines in sizes:
+        cart = make_cart(lines)
+        number = max(10, 20000 // lines)
+        old = min(timeit.repeat(lambda: old_loop(cart), number=number, repeat=5)) / number * 1e6
+        new = min(timeit.repeat(lambda: price_items(cart), number=number, repeat=5)) / number * 1e6
+        print("%8d %14.1f %14.1f" % (lines, old, new))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [10, 100, 500, 1000])
@@ -0,0 +1,114 @@
+# Cold start: how long "import main" takes, which modules it spends that time on, and how long a fresh
+# process needs to answer its first request, in-process (create_app + test client) and under gunicorn.
+#
+# Every measurement runs in a new interpreter, so nothing is already imported or cached. The database is
+# migrated once up front, like the Procfile's release step; the timed starts must not touch the schema.
+#
+#   python benchmarks/startup_bench.py --runs 5 --top 15 [--max-import-ms 1500] [--no-gunicorn]
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from storefront_bench import ROOT, load_app, percentile, seed
+
+FIRST_REQUEST = """
+import time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+app = main.create_app()
+created = time.perf_counter()
+response = app.test_client().get("/")
+assert response.status_code == 200, response.status_code
+print(imported - started, created - imported, time.perf_counter() - created)
+"""
+
+
+def environment(db_uri):
+    return dict(os.environ, DB_URI=db_uri, FLASK_KEY=os.environ.get("FLASK_KEY", "benchmark"), HASH_WORKERS="0",
+                PAYMENT_GATEWAY="fake", INVOICE_CACHE_DIR=tempfile.mkdtemp(prefix="invoices-"))
+
+
+def import_profile(env):
+    # -X importtime writes "import time: self [us] | cumulative | imported package" to stderr
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - started
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(own), int(cumulative)))
+    main_cumulative = next(cumulative for name, own, cumulative in modules if name == "main")
+    return wall, main_cumulative / 1e6, modules
+
+
+def top_packages(modules, top):
+    # self time summed per top-level package: "sqlalchemy" rather than fifty sqlalchemy.* lines
+    packages = {}
+    for name, own, cumulative in modules:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + own
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def first_request(env):
+    result = subprocess.run([sys.executable, "-c", FIRST_REQUEST], cwd=ROOT, env=env, capture_output=True,
+                            text=True, check=True)
+    return [float(value) for value in result.stdout.split()]
+
+
+def gunicorn_first_request(db_uri):
+    from worker_bench import start_server
+    started = time.perf_counter()
+    server, base = start_server("sync", 1, db_uri, 0)
+    elapsed = time.perf_counter() - started
+    server.terminate()
+    server.wait()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time and time to first response of a fresh process.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes per measurement")
+    parser.add_argument("--top", type=int, default=15, help="packages to list by import self time")
+    parser.add_argument("--max-import-ms", type=float, help="exit 1 when the median 'import main' exceeds this")
+    parser.add_argument("--no-gunicorn", action="store_true", help="skip the gunicorn time to first response")
+    args = parser.parse_args()
+
+    db_uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="startupbench-"), "bench.db")
+    main_module, app = load_app(db_uri)
+    with app.app_context():
+        seed(main_module, 5, 5, 200, 1, 0)
+        main_module.db.engine.dispose()
+    env = environment(db_uri)
+
+    profiles = [import_profile(env) for _ in range(args.runs)]
+    import_ms = sorted(profile[1] * 1000 for profile in profiles)
+    print("import main: median %.0fms, min %.0fms (interpreter wall time incl. startup: median %.0fms)" % (
+        percentile(import_ms, 50), import_ms[0], percentile([profile[0] * 1000 for profile in profiles], 50)))
+    print("%-24s %10s" % ("package", "self ms"))
+    for package, own in top_packages(profiles[-1][2], args.top):
+        print("%-24s %10.1f" % (package, own / 1000))
+
+    starts = [first_request(env) for _ in range(args.runs)]
+    print("first response in-process: import %.0fms + create_app %.0fms + first GET / %.0fms (medians)" % tuple(
+        percentile([start[i] * 1000 for start in starts], 50) for i in range(3)))
+    if not args.no_gunicorn:
+        runs = [gunicorn_first_request(db_uri) for _ in range(args.runs)]
+        print("first response under gunicorn (1 sync worker, preload): median %.0fms" % (percentile(runs, 50) * 1000))
+
+    if args.max_import_ms is not None and percentile(import_ms, 50) > args.max_import_ms:
+        print("import main takes %.0fms, over the %.0fms budget" % (percentile(import_ms, 50), args.max_import_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+# Load/latency benchmark for the storefront and checkout flows.
+#
+# Seeds a throwaway SQLite database (or the database in --db) with a synthetic catalog, then drives the real
+# app through Flask's test client from several threads and reports p50/p95/p99 latency and throughput per flow.
+#
+#   python benchmarks/storefront_bench.py --products 20000 --threads 8 --out run.json
+#   python benchmarks/storefront_bench.py --compare run.json --tolerance 0.25   # exit 1 on a p95 regression
+#   python benchmarks/storefront_bench.py --replicas 2   # catalog reads from two SQLite copies of the primary
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = "benchmark-password"
+WORDS = ("classic leather running canvas cotton slim fit waterproof light heavy vintage sport casual "
+         "premium soft warm summer winter denim wool knit stretch").split()
+COLORS = "red,blue,green,black,white"
+
+
+def load_app(db_uri):
+    # main reads its configuration from the environment; returns the module and an app with an up to date schema
+    os.environ["DB_URI"] = db_uri
+    os.environ.setdefault("FLASK_KEY", "benchmark")
+    os.environ.setdefault("INVOICE_CACHE_DIR", tempfile.mkdtemp(prefix="invoices-"))
+    # payments go to the in-process fake gateway; FAKE_GATEWAY_LATENCY sets its per-charge delay
+    os.environ.setdefault("PAYMENT_GATEWAY", "fake")
+    os.chdir(ROOT)
+    import main
+    app = main.create_app({"TESTING": True, "WTF_CSRF_ENABLED": False})
+    with app.app_context():
+        main.migrate()
+    return main, app
+
+
+def seed(main, brands, categories, products, users, orders):
+    from werkzeug.security import generate_password_hash
+    from passwords import SALT_LENGTH
+    from pricing import price_items
+    import order_lines
+
+    db = main.db
+    rnd = random.Random(42)
+    db.session.execute(db.insert(main.Brand), [{"name": "Brand %d" % i} for i in range(1, brands + 1)])
+    db.session.execute(db.insert(main.Category), [{"name": "category %d" % i} for i in range(1, categories + 1)])
+
+    batch = []
+    for i in range(1, products + 1):
+        batch.append({"name": "Product %d" % i, "price": "%d.%02d" % (rnd.randint(5, 400), rnd.randint(0, 99)),
+                      "discount": rnd.choice([0, 0, 5, 10, 25]), "stock": rnd.choice([0] + [rnd.randint(1, 1000)] * 9),
+                      "description": " ".join(rnd.choice(WORDS) for _ in range(30)), "colors": COLORS,
+                      "brand_id": rnd.randint(1, brands), "category_id": rnd.randint(1, categories),
+                      "image_1": "placeholder.jpg", "image_2": "placeholder.jpg", "image_3": "placeholder.jpg"})
+        if len(batch) == 1000:
+            db.session.execute(db.insert(main.Product), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(main.Product), batch)
+
+    db.session.execute(db.insert(main.User), [
+        {"first_name": "bench", "last_name": "user%d" % i, "username": "bench%d" % i, "email": "bench%d@example.com" % i,
+         # the app's current hash settings, so logins don't spend time upgrading the seeded hashes
+         "password": generate_password_hash(PASSWORD, method=main.password_hasher.method, salt_length=SALT_LENGTH),
+         "address": "1 Bench Street", "state": "CA", "country": "US", "zipcode": 90000 + i, "profile_pic": "bench%d.jpg" % i}
+        for i in range(1, users + 1)])
+
+    batch = []
+    for i in range(1, orders + 1):
+        items = {}
+        for _ in range(rnd.randint(1, 5)):
+            product_id = rnd.randint(1, products)
+            items[str(product_id)] = {"name": "Product %d" % product_id, "price": "%d.00" % rnd.randint(5, 400),
+                                      "discount": 0, "quantity": rnd.randint(1, 3), "color": "red"}
+        totals = price_items(items)
+        for key, value in items.items():
+            value["line_total"] = str(totals.lines[key])
+        batch.append({"invoice": "bench%08d" % i, "status": rnd.choice(["pending", "paid"]),
+                      "date_created": datetime.utcnow(), "customer_id": rnd.randint(1, users), "items": items,
+                      "amount": totals.amount, "tax": totals.tax, "total": totals.total})
+        if len(batch) == 1000:
+            db.session.execute(db.insert(main.Order), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(main.Order), batch)
+    db.session.commit()
+    # orders are seeded in the old json form and moved over the way a real upgrade would be
+    order_lines.backfill(db, main.Order, main.OrderLine)
+    main.product_search.reindex()
+
+
+class VirtualUser:
+
+    def __init__(self, app, number, products, invoices):
+        self.client = app.test_client()
+        # an address of its own, like a real visitor: LoginThrottle counts attempts per address
+        self.client.environ_base["REMOTE_ADDR"] = "10.0.%d.%d" % (number // 250, number % 250 + 1)
+        self.email = "bench%d@example.com" % number
+        self.products = products  # ids with plenty of stock, so checkouts aren't rejected
+        self.rnd = random.Random(number)
+        self.invoices = invoices
+
+    def request(self, method, url, **kwargs):
+        response = self.client.open(url, method=method, **kwargs)
+        response.close()
+        if response.status_code >= 400:
+            raise RuntimeError("%s %s -> %d" % (method, url, response.status_code))
+        return response
+
+    def product_id(self):
+        return self.rnd.choice(self.products)
+
+    # one method per measured flow; setup steps that aren't being measured go through self.request too
+
+    def login(self):
+        response = self.request("POST", "/", data={"email": self.email, "password": PASSWORD})
+        if "/home" not in response.headers.get("Location", ""):
+            raise RuntimeError("login failed for %s" % self.email)
+
+    def home(self):
+        self.request("GET", "/home")
+
+    def home_deep(self):
+        # a cursor near the end of the catalog: the last pages
+        self.request("GET", "/home?after=%d" % self.rnd.randint(2, 40))
+
+    def product_details(self):
+        self.request("GET", "/product/%d" % self.product_id())
+
+    def api_ids(self):
+        # what the mobile app does for a saved list: one batched lookup of a few products
+        ids = ",".join(str(self.product_id()) for _ in range(10))
+        self.request("GET", "/api/v1/products?fields=id,name,price,discount,image_1&ids=" + ids)
+
+    def api_page(self):
+        self.request("GET", "/api/v1/products?in_stock=1&per_page=50&after=%d" % self.rnd.randint(60, 5000))
+
+    def search_results(self):
+        self.request("POST", "/search_results", data={"keyword": self.rnd.choice(WORDS)})
+
+    def add2cart(self):
+        self.request("POST", "/add-to-cart", data={"product_id": str(self.product_id()), "quantity": "1", "color": "red"})
+
+    def cart_items(self):
+        self.request("GET", "/cart_items")
+
+    def make_order(self):
+        response = self.request("GET", "/checkout")
+        location = response.headers.get("Location", "")
+        if "invoice:" not in location:
+            raise RuntimeError("checkout was rejected")
+        self.invoices.append(location.split("invoice:")[-1])
+
+    def order_details(self):
+        self.request("GET", "/order/invoice:" + self.rnd.choice(self.invoices))
+
+    def pay(self):
+        # pays the order the setup step just placed
+        response = self.request("POST", "/purchase", data={"invoice": self.invoices[-1], "stripeToken": "tok_visa"})
+        if "/thanx" not in response.headers.get("Location", ""):
+            raise RuntimeError("payment was not confirmed in time")
+
+
+FLOWS = ("login", "home", "home_deep", "product_details", "api_ids", "api_page", "search_results", "add2cart",
+         "cart_items", "make_order", "order_details", "pay")
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)]
+
+
+def run_flow(users, flow, requests_per_user):
+    timings = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(user):
+        local = []
+        for _ in range(requests_per_user):
+            if flow in ("cart_items", "make_order", "pay"):
+                user.add2cart()  # these need something in the cart; not part of the measurement
+            if flow == "pay":
+                user.make_order()
+            start = time.perf_counter()
+            try:
+                getattr(user, flow)()
+            except Exception as error:
+                with lock:
+                    errors.append(str(error))
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            timings.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(user,)) for user in users]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+
+    return {"count": len(timings), "errors": len(errors), "first_error": errors[0] if errors else None,
+            "p50_ms": round(percentile(timings, 50) * 1000, 3), "p95_ms": round(percentile(timings, 95) * 1000, 3),
+            "p99_ms": round(percentile(timings, 99) * 1000, 3), "rps": round(len(timings) / wall, 1) if wall else 0.0}
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for flow, base in baseline["results"].items():
+        current = results.get(flow)
+        if current and base["p95_ms"] and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append("%s: p95 %.1f ms -> %.1f ms" % (flow, base["p95_ms"], current["p95_ms"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Storefront and checkout latency benchmark.")
+    parser.add_argument("--db", help="database URI to seed (default: a new SQLite file)")
+    parser.add_argument("--brands", type=int, default=20)
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4, help="concurrent virtual users")
+    parser.add_argument("--requests", type=int, default=50, help="requests per virtual user per flow")
+    parser.add_argument("--flows", default=",".join(FLOWS))
+    parser.add_argument("--out", help="write results as JSON")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --out")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown against --compare")
+    parser.add_argument("--check-plans", action="store_true", help="run the query-plan check on the seeded data")
+    parser.add_argument("--replicas", type=int, default=0,
+                        help="SQLite files standing in for read replicas (DB_REPLICA_URIS), copied from the seeded primary")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="shopbench-")
+    db_uri = args.db or "sqlite:///" + os.path.join(directory, "bench.db")
+    if args.replicas:
+        os.environ["DB_REPLICA_URIS"] = ",".join("sqlite:///" + os.path.join(directory, "replica%d.db" % number)
+                                                 for number in range(1, args.replicas + 1))
+    main_module, app = load_app(db_uri)
+    plan_failures = {}
+    with app.app_context():
+        started = time.perf_counter()
+        seed(main_module, args.brands, args.categories, args.products, max(args.users, args.threads), args.orders)
+        print("seeded %d products, %d orders in %.1fs (%s)" % (args.products, args.orders,
+                                                               time.perf_counter() - started, db_uri))
+        if args.check_plans:
+            main_module.db.session.execute(main_module.db.text("ANALYZE"))
+            main_module.db.session.commit()
+            plan_failures = main_module.query_plans.check(main_module.db, main_module.route_queries())
+            for name, plan in plan_failures.items():
+                print("full scan in %s: %s" % (name, "; ".join(plan)))
+        if args.replicas:
+            main_module.copy_sqlite(main_module.db.engine, main_module.replicas.engines)
+
+    with app.app_context():
+        db, Product, Order = main_module.db, main_module.Product, main_module.Order
+        stocked = db.session.execute(db.select(Product.id).where(Product.stock > 100)).scalars().all()
+        invoices = {}
+        for customer_id, invoice in db.session.execute(db.select(Order.customer_id, Order.invoice)):
+            invoices.setdefault(customer_id, []).append(invoice)
+    # users were inserted in order, so bench<n> has id n
+    users = [VirtualUser(app, number, stocked, invoices.get(number, []))
+             for number in range(1, args.threads + 1)]
+    for user in users:
+        user.login()
+
+    results = {}
+    print("%-16s %8s %7s %9s %9s %9s %9s" % ("flow", "count", "errors", "p50 ms", "p95 ms", "p99 ms", "req/s"))
+    for flow in args.flows.split(","):
+        results[flow] = run_flow(users, flow, args.requests)
+        r = results[flow]
+        print("%-16s %8d %7d %9.2f %9.2f %9.2f %9.1f" % (flow, r["count"], r["errors"], r["p50_ms"], r["p95_ms"],
+                                                        r["p99_ms"], r["rps"]))
+        if r["first_error"]:
+            print("    first error: %s" % r["first_error"])
+
+    with app.app_context():
+        oversold = main_module.db.session.execute(
+            main_module.db.select(main_module.db.func.count()).select_from(main_module.Product)
+            .where(main_module.Product.stock < 0)).scalar()
+    if oversold:
+        print("%d products were oversold" % oversold)
+    if args.replicas:
+        print("connection checkouts: " + ", ".join("%s %d" % (name, stats["checkouts"])
+                                                  for name, stats in main_module.pool_stats.stats().items()))
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump({"config": vars(args), "db": db_uri, "results": results}, out, indent=2)
+
+    failed = bool(oversold) or bool(plan_failures)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for line in regressions:
+            print("regression: " + line)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
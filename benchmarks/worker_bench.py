@@ -0,0 +1,200 @@
+# Throughput of the real gunicorn server (gunicorn.conf.py) per worker class.
+#
+# Seeds a throwaway SQLite catalog, then for each worker class starts gunicorn on it and drives it over HTTP
+# from --clients threads for --duration seconds. Half the clients browse (home + product page), the other
+# half check out and pay through the fake gateway, whose FAKE_GATEWAY_LATENCY stands in for Stripe.
+#
+#   python benchmarks/worker_bench.py --classes sync,gthread,gevent --workers 2 --clients 32 --duration 20
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from storefront_bench import PASSWORD, ROOT, load_app, percentile, seed
+
+CSRF = re.compile(r'<input[^>]*name="csrf_token"[^>]*value="([^"]+)"')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+
+    def __init__(self, base, number, products):
+        self.base = base
+        self.email = "bench%d@example.com" % number
+        self.products = products
+        self.rnd = random.Random(number)
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                                  NoRedirect())
+
+    def open(self, path, data=None):
+        # returns (status, Location header); redirects are not followed
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(self.base + path, body, timeout=60) as response:
+                response.read()
+                return response.status, response.headers.get("Location", "")
+        except urllib.error.HTTPError as error:
+            error.read()
+            if error.code >= 400:
+                raise RuntimeError("%s -> %d" % (path, error.code))
+            return error.code, error.headers.get("Location", "")
+
+    def login(self):
+        with self.opener.open(self.base + "/", timeout=60) as response:
+            token = CSRF.search(response.read().decode()).group(1)
+        status, location = self.open("/", {"email": self.email, "password": PASSWORD, "csrf_token": token})
+        if "/home" not in location:
+            raise RuntimeError("login failed for %s" % self.email)
+
+    def browse(self):
+        self.open("/home")
+        self.open("/product/%d" % self.rnd.choice(self.products))
+
+    def checkout_and_pay(self):
+        self.open("/add-to-cart", {"product_id": str(self.rnd.choice(self.products)), "quantity": "1", "color": "red"})
+        status, location = self.open("/checkout")
+        if "invoice:" not in location:
+            raise RuntimeError("checkout was rejected")
+        status, location = self.open("/purchase", {"invoice": location.split("invoice:")[-1], "stripeToken": "tok_visa"})
+        if "/thanx" not in location and "/order/" not in location:
+            raise RuntimeError("payment failed")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(worker_class, workers, db_uri, latency):
+    port = free_port()
+    env = dict(os.environ, DB_URI=db_uri, PORT=str(port), GUNICORN_WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY=str(workers), PAYMENT_GATEWAY="fake", FAKE_GATEWAY_LATENCY=str(latency),
+               FLASK_KEY=os.environ.get("FLASK_KEY", "benchmark"),
+               # every client connects from 127.0.0.1, so the per-address login limit would see one visitor
+               LOGIN_ATTEMPTS_PER_IP=os.environ.get("LOGIN_ATTEMPTS_PER_IP", "1000000"),
+               INVOICE_CACHE_DIR=tempfile.mkdtemp(prefix="invoices-"))
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "main:create_app()"],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn (%s) exited: %s" % (worker_class, server.stderr.read().decode()[-2000:]))
+        try:
+            urllib.request.urlopen("http://127.0.0.1:%d/" % port, timeout=2).read()
+            return server, "http://127.0.0.1:%d" % port
+        except (urllib.error.URLError, ConnectionError, socket.timeout):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError("gunicorn (%s) did not start" % worker_class)
+
+
+def run(base, clients, products, duration):
+    users = [Client(base, number, products) for number in range(1, clients + 1)]
+    for user in users:
+        user.login()
+    timings = {"browse": [], "checkout_and_pay": []}
+    errors = []
+    lock = threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def worker(user, flow):
+        local = []
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            try:
+                getattr(user, flow)()
+            except Exception as error:
+                with lock:
+                    errors.append(str(error))
+                continue
+            local.append(time.perf_counter() - start)
+        with lock:
+            timings[flow].extend(local)
+
+    threads = [threading.Thread(target=worker, args=(user, "browse" if i % 2 == 0 else "checkout_and_pay"))
+               for i, user in enumerate(users)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    return {flow: {"count": len(samples), "per_s": round(len(samples) / wall, 1),
+                   "p50_ms": round(percentile(samples, 50) * 1000, 1), "p95_ms": round(percentile(samples, 95) * 1000, 1)}
+            for flow, samples in timings.items()}, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gunicorn worker class throughput benchmark.")
+    parser.add_argument("--classes", default="sync,gthread,gevent")
+    parser.add_argument("--workers", type=int, default=2, help="worker processes for every class")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent HTTP clients")
+    parser.add_argument("--duration", type=float, default=15, help="seconds per worker class")
+    parser.add_argument("--products", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake payment gateway latency in seconds")
+    parser.add_argument("--out", help="write results as JSON")
+    args = parser.parse_args()
+
+    db_uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="workerbench-"), "bench.db")
+    main_module, app = load_app(db_uri)
+    with app.app_context():
+        seed(main_module, 10, 5, args.products, args.clients, 0)
+        db, Product = main_module.db, main_module.Product
+        # stock for the whole run, so checkouts are never turned away
+        db.session.execute(db.update(Product).values(stock=1000000))
+        db.session.commit()
+        products = db.session.execute(db.select(Product.id)).scalars().all()
+        # sqlite has one writer at a time; WAL at least lets readers through while it writes
+        db.session.execute(db.text("PRAGMA journal_mode=WAL"))
+        db.session.commit()
+        db.engine.dispose()
+
+    results = {}
+    print("%-8s %8s %10s %10s %10s %10s %10s %7s" % ("class", "workers", "browse/s", "browse p95", "pay/s",
+                                                     "pay p95", "total/s", "errors"))
+    for worker_class in args.classes.split(","):
+        if worker_class == "gevent":
+            try:
+                import gevent  # noqa: F401
+            except ImportError:
+                print("%-8s skipped: gevent is not installed" % worker_class)
+                continue
+        server, base = start_server(worker_class, args.workers, db_uri, args.latency)
+        try:
+            flows, errors = run(base, args.clients, products, args.duration)
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+        results[worker_class] = dict(flows, errors=len(errors), first_error=errors[0] if errors else None)
+        browse, pay = flows["browse"], flows["checkout_and_pay"]
+        print("%-8s %8d %10.1f %10.1f %10.1f %10.1f %10.1f %7d" % (
+            worker_class, args.workers, browse["per_s"], browse["p95_ms"], pay["per_s"], pay["p95_ms"],
+            browse["per_s"] + pay["per_s"], len(errors)))
+        if errors:
+            print("    first error: %s" % errors[0])
+
+    if args.out:
+        with open(args.out, "w") as out:
+            json.dump({"config": vars(args), "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
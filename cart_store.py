@@ -0,0 +1,129 @@
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+
+# A cart is stored as {product_id (str): {"quantity": int, "color": str}}, in the order items were added.
+# Name, price, stock etc. are never stored here; they are joined in from Product when the cart is rendered.
+
+
+class MemoryCartStore:
+    # Process-local, for tests and single-worker runs. Carts are lost on restart and not shared between workers.
+
+    def __init__(self):
+        self._carts = {}
+        self._added = {}  # cart id -> when its newest line was added
+        self._lock = threading.Lock()
+
+    def lines(self, cart_id):
+        with self._lock:
+            return {key: dict(line) for key, line in self._carts.get(cart_id, {}).items()}
+
+    def add(self, cart_id, product_id, quantity, color):
+        # returns False when the product was already in the cart and only its quantity was raised
+        with self._lock:
+            cart = self._carts.setdefault(cart_id, {})
+            line = cart.get(str(product_id))
+            if line is not None:
+                line["quantity"] += int(quantity)
+                return False
+            cart[str(product_id)] = {"quantity": int(quantity), "color": color}
+            self._added[cart_id] = datetime.utcnow()
+            return True
+
+    def update(self, cart_id, product_id, quantity, color):
+        with self._lock:
+            line = self._carts.get(cart_id, {}).get(str(product_id))
+            if line is None:
+                return False
+            line["quantity"] = int(quantity)
+            line["color"] = color
+            return True
+
+    def remove(self, cart_id, product_id):
+        with self._lock:
+            self._carts.get(cart_id, {}).pop(str(product_id), None)
+
+    def clear(self, cart_id):
+        with self._lock:
+            self._carts.pop(cart_id, None)
+            self._added.pop(cart_id, None)
+
+    def purge(self, days):
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        with self._lock:
+            stale = [cart_id for cart_id, added in self._added.items() if added < cutoff]
+            lines = 0
+            for cart_id in stale:
+                lines += len(self._carts.pop(cart_id, {}))
+                self._added.pop(cart_id, None)
+        return lines
+
+
+class SqlCartStore:
+
+    def __init__(self, db, cart_line_model):
+        self.db = db
+        self.CartLine = cart_line_model
+
+    def lines_query(self, cart_id):
+        # also checked by "flask check-query-plans"; ix_cart_lines_added serves both the lookup and the order
+        CartLine = self.CartLine
+        return (self.db.select(CartLine.product_id, CartLine.quantity, CartLine.color)
+                .where(CartLine.cart_id == cart_id).order_by(CartLine.added_at, CartLine.product_id))
+
+    def lines(self, cart_id):
+        rows = self.db.session.execute(self.lines_query(cart_id)).all()
+        return {str(row.product_id): {"quantity": row.quantity, "color": row.color} for row in rows}
+
+    def _raise_quantity(self, cart_id, product_id, quantity):
+        CartLine = self.CartLine
+        return self.db.session.execute(
+            self.db.update(CartLine)
+            .where(CartLine.cart_id == cart_id, CartLine.product_id == int(product_id))
+            .values(quantity=CartLine.quantity + int(quantity))).rowcount
+
+    def add(self, cart_id, product_id, quantity, color):
+        if self._raise_quantity(cart_id, product_id, quantity):
+            self.db.session.commit()
+            return False
+        try:
+            with self.db.session.begin_nested():
+                self.db.session.add(
+                    self.CartLine(cart_id=cart_id, product_id=int(product_id), quantity=int(quantity), color=color))
+        except IntegrityError:
+            # a concurrent add (double click, second tab) inserted the line after our UPDATE found nothing
+            self._raise_quantity(cart_id, product_id, quantity)
+            self.db.session.commit()
+            return False
+        self.db.session.commit()
+        return True
+
+    def update(self, cart_id, product_id, quantity, color):
+        CartLine = self.CartLine
+        result = self.db.session.execute(
+            self.db.update(CartLine)
+            .where(CartLine.cart_id == cart_id, CartLine.product_id == int(product_id))
+            .values(quantity=int(quantity), color=color))
+        self.db.session.commit()
+        return result.rowcount > 0
+
+    def remove(self, cart_id, product_id):
+        CartLine = self.CartLine
+        self.db.session.execute(
+            self.db.delete(CartLine).where(CartLine.cart_id == cart_id, CartLine.product_id == int(product_id)))
+        self.db.session.commit()
+
+    def clear(self, cart_id):
+        self.db.session.execute(self.db.delete(self.CartLine).where(self.CartLine.cart_id == cart_id))
+        self.db.session.commit()
+
+    def purge(self, days):
+        # drops carts nobody has added to for `days` days; returns how many lines went
+        CartLine = self.CartLine
+        stale = (self.db.select(CartLine.cart_id).group_by(CartLine.cart_id)
+                 .having(self.db.func.max(CartLine.added_at) < datetime.utcnow() - timedelta(days=days)))
+        result = self.db.session.execute(self.db.delete(CartLine).where(CartLine.cart_id.in_(stale)))
+        self.db.session.commit()
+        return result.rowcount
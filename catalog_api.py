@@ -0,0 +1,133 @@
+import json
+from decimal import Decimal
+
+from pagination import keyset_paginate
+
+MAX_IDS = 100
+MAX_PER_PAGE = 100
+
+
+class ApiError(Exception):
+    # a bad query string; the route answers 400 with the message
+    pass
+
+
+class CatalogApi:
+    # Read-only JSON over products, brands and categories for the mobile app and edge caches.
+    # Every request is one SELECT of just the requested columns; rows come back as plain tuples
+    # and are zipped straight into dicts, without building ORM objects.
+    #
+    #   ?fields=id,name,price   columns to return (id is always included, it is the cursor)
+    #   ?ids=3,1,2              those rows in that order, one IN query; unknown ids are listed in "missing"
+    #   ?after=<next_cursor>    next page, newest first (keyset_paginate, like the storefront listings);
+    #                           ?before=<prev_cursor> goes back
+    #   ?brand=<id>&category=<id>&in_stock=1   product filters
+
+    def __init__(self, db, Product, Brand, Category):
+        self.db = db
+        self.Product = Product
+        self.Brand = Brand
+        self.Category = Category
+        # name -> column expression; brand/category names cost a join only when asked for
+        self.resources = {
+            "products": (Product, {
+                "id": Product.id, "name": Product.name, "price": Product.price, "discount": Product.discount,
+                "stock": Product.stock, "description": Product.description, "colors": Product.colors,
+                "brand_id": Product.brand_id, "category_id": Product.category_id,
+                "brand": Brand.name, "category": Category.name,
+                "image_1": Product.image_1, "image_2": Product.image_2, "image_3": Product.image_3,
+            }),
+            "brands": (Brand, {"id": Brand.id, "name": Brand.name}),
+            "categories": (Category, {"id": Category.id, "name": Category.name}),
+        }
+        self.default_fields = {
+            "products": ("id", "name", "price", "discount", "stock", "brand_id", "category_id", "image_1"),
+            "brands": ("id", "name"),
+            "categories": ("id", "name"),
+        }
+
+    def _fields(self, resource, requested):
+        columns = self.resources[resource][1]
+        if not requested:
+            names = list(self.default_fields[resource])
+        else:
+            names = [name.strip() for name in requested.split(",") if name.strip()]
+            unknown = [name for name in names if name not in columns]
+            if unknown:
+                raise ApiError("unknown field(s) %s; available: %s" % (",".join(unknown), ",".join(columns)))
+        # id first: ?ids= batches are matched up by row[0]
+        return list(dict.fromkeys(["id"] + names))
+
+    def select(self, resource, names):
+        # the unordered statement behind listing()/detail(); "flask check-query-plans" checks it too
+        model, columns = self.resources[resource]
+        statement = self.db.select(*[columns[name].label(name) for name in names]).select_from(model)
+        if resource == "products":
+            if "brand" in names:
+                statement = statement.outerjoin(self.Brand, self.Product.brand_id == self.Brand.id)
+            if "category" in names:
+                statement = statement.outerjoin(self.Category, self.Product.category_id == self.Category.id)
+        return statement
+
+    def _serializer(self, resource, names):
+        # one converter per column, decided once per request instead of per value
+        columns = self.resources[resource][1]
+        decimals = [i for i, name in enumerate(names) if columns[name].type.python_type is Decimal]
+
+        def serialize(rows):
+            if not decimals:
+                return [dict(zip(names, row)) for row in rows]
+            items = []
+            for row in rows:
+                values = list(row)
+                for i in decimals:
+                    if values[i] is not None:
+                        values[i] = str(values[i])
+                items.append(dict(zip(names, values)))
+            return items
+        return serialize
+
+    def _filters(self, resource, args):
+        if resource != "products":
+            return []
+        conditions = []
+        if args.get("brand", type=int):
+            conditions.append(self.Product.brand_id == args.get("brand", type=int))
+        if args.get("category", type=int):
+            conditions.append(self.Product.category_id == args.get("category", type=int))
+        if args.get("in_stock") in ("1", "true"):
+            conditions.append(self.Product.stock > 0)
+        return conditions
+
+    def listing(self, resource, args):
+        # a page or an ?ids= batch as a dict ready for dumps()
+        names = self._fields(resource, args.get("fields"))
+        statement = self.select(resource, names)
+        key = self.resources[resource][1]["id"]
+        serialize = self._serializer(resource, names)
+
+        if args.get("ids"):
+            try:
+                ids = list(dict.fromkeys(int(value) for value in args["ids"].split(",") if value.strip()))
+            except ValueError:
+                raise ApiError("ids must be a comma separated list of integers")
+            if len(ids) > MAX_IDS:
+                raise ApiError("at most %d ids per request" % MAX_IDS)
+            rows = {row[0]: row for row in self.db.session.execute(statement.where(key.in_(ids)))}
+            return {"items": serialize(rows[i] for i in ids if i in rows), "missing": [i for i in ids if i not in rows]}
+
+        per_page = min(max(args.get("per_page", 20, type=int), 1), MAX_PER_PAGE)
+        statement = statement.where(*self._filters(resource, args))
+        page = keyset_paginate(self.db, statement, key, after=args.get("after", type=int),
+                               before=args.get("before", type=int), per_page=per_page, scalars=False)
+        return {"items": serialize(page.items), "next_cursor": page.next_cursor, "prev_cursor": page.prev_cursor}
+
+    def detail(self, resource, id, args):
+        names = self._fields(resource, args.get("fields"))
+        statement = self.select(resource, names).where(self.resources[resource][1]["id"] == id)
+        row = self.db.session.execute(statement).first()
+        return self._serializer(resource, names)([row])[0] if row is not None else None
+
+    @staticmethod
+    def dumps(payload):
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
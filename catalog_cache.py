@@ -0,0 +1,54 @@
+import threading
+import time
+
+
+class VersionedCache:
+    # Process-local cache. Every write bumps the version, which drops all entries;
+    # the TTL bounds how stale other gunicorn workers can get, since they never see the bump.
+
+    def __init__(self, ttl=60, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = 0
+        self.changed_at = time.time()
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == self.version and entry[1] > now:
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            version = self.version
+
+        value = loader()
+
+        with self._lock:
+            # a write that happened while we were loading makes this value stale already
+            if version == self.version:
+                if self.max_entries and len(self._entries) >= self.max_entries:
+                    self._entries.clear()  # keys come from request args, so don't let them pile up
+                self._entries[key] = (version, now + self.ttl, value)
+        return value
+
+    def forget(self, key):
+        # drops one entry, for writes that only affect that key; a load already running can
+        # still store the old value, which then lives for at most one ttl
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self.changed_at = time.time()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"version": self.version, "ttl": self.ttl, "entries": len(self._entries),
+                    "hits": self.hits, "misses": self.misses}
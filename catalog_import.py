@@ -0,0 +1,277 @@
+import csv
+import io
+import json
+import os
+import threading
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+
+from concurrency import cpu_executor
+
+# the columns read by the import and written by the export, in file order
+COLUMNS = ("name", "price", "discount", "stock", "description", "colors", "brand", "category",
+           "image_1", "image_2", "image_3")
+IMAGE_COLUMNS = ("image_1", "image_2", "image_3")
+
+
+def read_rows(stream, filename):
+    # stream: a binary file. CSV with a header row, or JSON Lines for .jsonl/.ndjson.
+    # A JSON line that doesn't parse is yielded as the ValueError, so it is reported against its row.
+    text_stream = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if filename.lower().endswith((".jsonl", ".ndjson")):
+        for line in text_stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError as error:
+                    yield error
+    else:
+        yield from csv.DictReader(text_stream)
+
+
+class ImportReport:
+
+    def __init__(self):
+        self.created = 0
+        self.errors = []  # (row number, product name, message); rows are numbered from 1, header excluded
+
+    def error(self, number, name, message):
+        self.errors.append((number, name, message))
+
+    def as_dict(self):
+        return {"created": self.created, "failed": len(self.errors),
+                "errors": [{"row": number, "name": name, "error": message} for number, name, message in self.errors]}
+
+
+class ProductImporter:
+    # Imports products from rows of COLUMNS. Brands and categories are matched by name through maps
+    # loaded once (unknown ones are created along with the first product that uses them). Rows are validated,
+    # then inserted batch_size at a time, one transaction per batch together with their search index rows and
+    # new brands/categories, so a failure only costs its batch and leaves nothing half-created behind.
+    # Images named by the rows come from a zip archive and are stored by a thread pool while the batch is
+    # prepared; names not in the archive must already be in the image folder.
+
+    def __init__(self, db, Product, Brand, Category, images, search, batch_size=500, max_workers=4):
+        self.db = db
+        self.Product = Product
+        self.Brand = Brand
+        self.Category = Category
+        self.images = images
+        self.search = search
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+
+    def run(self, rows, archive=None):
+        # archive: an open zipfile.ZipFile, or None. One import at a time; the maps below are per run.
+        with self._lock:
+            return self._run(rows, archive)
+
+    def _run(self, rows, archive):
+        report = ImportReport()
+        self._brands = self._name_map(self.Brand)
+        self._categories = self._name_map(self.Category)
+        self._members = {}
+        if archive is not None:
+            for member in archive.namelist():
+                self._members.setdefault(member, member)
+                self._members.setdefault(os.path.basename(member), member)
+        self._stored = {}
+        self._seen = set()
+
+        batch = []
+        with cpu_executor(self.max_workers, "import-images") as pool:
+            for number, row in enumerate(rows, start=1):
+                if isinstance(row, Exception):
+                    report.error(number, None, "not valid JSON: %s" % row)
+                    continue
+                try:
+                    batch.append((number, self._validate(row)))
+                except ValueError as error:
+                    report.error(number, row.get("name") if isinstance(row, dict) else None, str(error))
+                if len(batch) == self.batch_size:
+                    self._insert_batch(batch, archive, pool, report)
+                    batch = []
+            if batch:
+                self._insert_batch(batch, archive, pool, report)
+        report.errors.sort(key=lambda error: error[0])
+        return report
+
+    def _name_map(self, model):
+        return {name.lower(): id for id, name in self.db.session.execute(self.db.select(model.id, model.name))}
+
+    @staticmethod
+    def _group_name(row, column):
+        name = str(row.get(column) or "").strip()
+        if len(name) > 30:
+            raise ValueError("%s is longer than 30 characters" % name)
+        return name
+
+    def _resolve(self, model, names, name, normalize, created):
+        # same spelling rules as add_brand (Title Case) / add_category (lower case). New ones are only
+        # flushed: they are committed with the products that use them, or rolled back with them
+        key = name.lower()
+        if not key:
+            return None
+        if key not in names:
+            group = model(name=normalize(name))
+            self.db.session.add(group)
+            self.db.session.flush()
+            names[key] = group.id
+            created.append((names, key))
+        return names[key]
+
+    def _validate(self, row):
+        if not isinstance(row, dict):
+            raise ValueError("not a JSON object")
+        name = str(row.get("name") or "").strip()
+        if not name:
+            raise ValueError("name is required")
+        if len(name) > 100:
+            raise ValueError("name is longer than 100 characters")
+        if name.lower() in self._seen:
+            raise ValueError("the file already has a product with this name")
+        try:
+            price = Decimal(str(row.get("price")).strip())
+        except InvalidOperation:
+            raise ValueError("price is not a number")
+        if not price.is_finite() or price <= 0:
+            raise ValueError("price must be more than 0")
+        try:
+            discount = int(row.get("discount") or 0)
+            stock = int(row.get("stock") or 0)
+        except (TypeError, ValueError):
+            raise ValueError("discount and stock must be whole numbers")
+        if not 0 <= discount <= 100:
+            raise ValueError("discount must be between 0 and 100")
+        if stock < 0:
+            raise ValueError("stock can't be negative")
+        colors = row.get("colors") or ""
+        if isinstance(colors, list):
+            colors = ",".join(colors)
+
+        images = {}
+        for column in IMAGE_COLUMNS:
+            image = str(row.get(column) or "").strip()
+            if not image:
+                raise ValueError("%s is required" % column)
+            if not self.images.allowed(image):
+                raise ValueError("%s is not a jpg, png or gif" % column)
+            if image not in self._members and (secure_filename(image) != image
+                                               or not os.path.exists(os.path.join(self.images.root, image))):
+                raise ValueError("%s %s is not in the archive or the image folder" % (column, image))
+            images[column] = image
+
+        # brand and category stay names until the batch is inserted
+        values = {"name": name, "price": price, "discount": discount, "stock": stock,
+                  "description": str(row.get("description") or ""), "colors": str(colors),
+                  "brand": self._group_name(row, "brand"), "category": self._group_name(row, "category")}
+        values.update(images)
+        self._seen.add(name.lower())
+        return values
+
+    def _store_image(self, archive, member):
+        return self.images.store_bytes(archive.read(member), member)
+
+    def _insert_batch(self, batch, archive, pool, report):
+        db, Product = self.db, self.Product
+        existing = set(db.session.execute(
+            db.select(Product.name).where(Product.name.in_([values["name"] for _, values in batch]))).scalars())
+        rows = []
+        for number, values in batch:
+            if values["name"] in existing:
+                report.error(number, values["name"], "a product with this name already exists")
+            else:
+                rows.append((number, values))
+
+        # archive images this batch needs that earlier batches haven't stored yet
+        jobs = {}
+        for _, values in rows:
+            for column in IMAGE_COLUMNS:
+                member = self._members.get(values[column])
+                if member and member not in self._stored and member not in jobs:
+                    jobs[member] = pool.submit(self._store_image, archive, member)
+        for member, job in jobs.items():
+            try:
+                self._stored[member] = job.result()
+            except Exception as error:
+                self._stored[member] = error
+
+        ready = []
+        for number, values in rows:
+            try:
+                for column in IMAGE_COLUMNS:
+                    member = self._members.get(values[column])
+                    if member:
+                        stored = self._stored[member]
+                        if isinstance(stored, Exception):
+                            raise ValueError("%s could not be read from the archive: %s" % (column, stored))
+                        values[column] = stored
+            except ValueError as error:
+                report.error(number, values["name"], str(error))
+                continue
+            ready.append((number, values))
+        if not ready:
+            return
+
+        try:
+            report.created += self._insert([values for _, values in ready])
+        except IntegrityError:
+            # someone added one of these names meanwhile; redo the batch row by row to find it
+            for number, values in ready:
+                try:
+                    report.created += self._insert([values])
+                except IntegrityError:
+                    report.error(number, values["name"], "a product with this name already exists")
+        db.session.commit()
+
+    def _insert(self, rows):
+        # the products, their search rows and any brands/categories they introduce, in one savepoint
+        db, Product = self.db, self.Product
+        created_groups = []
+        try:
+            with db.session.begin_nested():
+                params = []
+                for values in rows:
+                    values = dict(values)
+                    values["brand_id"] = self._resolve(self.Brand, self._brands, values.pop("brand"), str.title,
+                                                       created_groups)
+                    values["category_id"] = self._resolve(self.Category, self._categories, values.pop("category"),
+                                                          str.lower, created_groups)
+                    params.append(values)
+                insert = db.insert(Product).returning(Product.id, Product.name, Product.description)
+                created = db.session.execute(insert, params).all()
+                self.search.index_many(created)
+        except IntegrityError:
+            # rolled back with the savepoint: forget their ids
+            for names, key in created_groups:
+                names.pop(key, None)
+            raise
+        return len(created)
+
+
+def export_lines(db, Product, Brand, Category, fmt="csv"):
+    # the whole catalog in import format, one line at a time as the rows come back from the database
+    statement = (db.select(Product.name, Product.price, Product.discount, Product.stock, Product.description,
+                           Product.colors, Brand.name.label("brand"), Category.name.label("category"),
+                           Product.image_1, Product.image_2, Product.image_3)
+                 .outerjoin(Brand, Brand.id == Product.brand_id).outerjoin(Category, Category.id == Product.category_id)
+                 .order_by(Product.id).execution_options(yield_per=500))
+    result = db.session.execute(statement)
+    if fmt == "jsonl":
+        for row in result:
+            yield json.dumps({key: str(value) if isinstance(value, Decimal) else value
+                              for key, value in row._mapping.items()}) + "\n"
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for row in result:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
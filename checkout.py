@@ -0,0 +1,67 @@
+from order_lines import lines_from_items
+
+
+class InsufficientStock(Exception):
+
+    def __init__(self, products):
+        # products: list of (name, stock left) for the lines that can't be filled
+        self.products = products
+        super().__init__(", ".join(name for name, stock in products))
+
+
+class InvalidQuantity(Exception):
+    # a line asks for fewer than one unit; "stock - qty" would put stock back instead of taking it
+
+    def __init__(self, products):
+        # products: names of the offending lines
+        self.products = products
+        super().__init__(", ".join(products))
+
+
+class Checkout:
+    # Stock for every line is taken in a single conditional UPDATE keyed by product id:
+    #   UPDATE product SET stock = stock - CASE id ... END WHERE id IN (...) AND stock >= CASE id ... END
+    # The database evaluates the stock check under the row lock it takes for the write (sqlite locks the
+    # whole file, postgres re-checks the WHERE clause after waiting on a concurrent update), so two checkouts
+    # can't both take the last unit. The order and its lines are added in the same transaction.
+
+    def __init__(self, db, product_model, order_model, line_model, sales=None):
+        self.db = db
+        self.Product = product_model
+        self.Order = order_model
+        self.OrderLine = line_model
+        self.sales = sales  # SalesRollups, updated in the same transaction
+
+    def place_order(self, invoice, customer_id, items, totals):
+        Product = self.Product
+        quantities = {}
+        for key, value in items.items():
+            quantities[int(key)] = quantities.get(int(key), 0) + int(value["quantity"])
+        invalid = [items[str(pid)]["name"] for pid, quantity in quantities.items() if quantity < 1]
+        if invalid:
+            raise InvalidQuantity(invalid)
+
+        qty = self.db.case(quantities, value=Product.id)
+        result = self.db.session.execute(
+            self.db.update(Product)
+            .where(Product.id.in_(quantities), Product.stock >= qty)
+            .values(stock=Product.stock - qty)
+            .execution_options(synchronize_session=False))
+
+        if result.rowcount != len(quantities):
+            self.db.session.rollback()
+            rows = self.db.session.execute(
+                self.db.select(Product.id, Product.name, Product.stock).where(Product.id.in_(quantities))).all()
+            stock = {row.id: row for row in rows}
+            short = [(stock[pid].name, stock[pid].stock) if pid in stock else (items[str(pid)]["name"], 0)
+                     for pid in quantities if pid not in stock or stock[pid].stock < quantities[pid]]
+            raise InsufficientStock(short)
+
+        order = self.Order(invoice=invoice, customer_id=customer_id,
+                           amount=totals.amount, tax=totals.tax, total=totals.total,
+                           lines=[self.OrderLine(**line) for line in lines_from_items(items, totals)])
+        self.db.session.add(order)
+        if self.sales is not None:
+            self.sales.record_order(order)
+        self.db.session.commit()
+        return order
@@ -0,0 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+def cpu_executor(max_workers, thread_name_prefix):
+    # Thread pool for CPU-bound background work (image resizing, hashing). Under gunicorn's gevent
+    # workers the stdlib pool's threads are monkey-patched into greenlets sharing one OS thread, so a
+    # resize would stall every request on that worker; gevent's own executor runs on real threads.
+    try:
+        from gevent import monkey
+    except ImportError:
+        monkey = None
+    if monkey is not None and monkey.is_module_patched("threading"):
+        from gevent.threadpool import ThreadPoolExecutor as NativeThreadPoolExecutor
+        return NativeThreadPoolExecutor(max_workers=max_workers)
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+
+def engine_options(uri, environ=os.environ):
+    # SQLALCHEMY_ENGINE_OPTIONS from the environment. Sizes are per worker process:
+    # a gunicorn worker holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections.
+    # a SELECT 1 on checkout only pays off where a server can drop the connection; a sqlite file can't
+    pre_ping = environ.get("DB_POOL_PRE_PING", "0" if uri.startswith("sqlite") else "1")
+    options = {"pool_pre_ping": pre_ping not in ("0", "false", "no")}
+    if uri.startswith("sqlite"):
+        return options  # sqlite picks its own pool; size/overflow don't apply to a file
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=int(environ.get("DB_POOL_SIZE", 5)),
+        max_overflow=int(environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(environ.get("DB_POOL_TIMEOUT", 30)),
+        # reconnect before the server or a proxy in between drops idle connections
+        pool_recycle=int(environ.get("DB_POOL_RECYCLE", 1800)),
+    )
+    if uri.startswith("postgres"):
+        connect_args = {"connect_timeout": int(environ.get("DB_CONNECT_TIMEOUT", 5))}
+        if environ.get("DB_STATEMENT_TIMEOUT_MS"):
+            connect_args["options"] = "-c statement_timeout=%d" % int(environ["DB_STATEMENT_TIMEOUT_MS"])
+        options["connect_args"] = connect_args
+    return options
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that reports how long each checkout waited for a free connection (wait_observer)
+
+    wait_observer = None
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeout:
+            if self.wait_observer:
+                self.wait_observer(time.perf_counter() - start, timed_out=True)
+            raise
+        if self.wait_observer:
+            self.wait_observer(time.perf_counter() - start)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() replaces the pool; keep reporting from the new one
+        pool = super().recreate()
+        pool.wait_observer = self.wait_observer
+        return pool
+
+
+_fork_engines = weakref.WeakSet()
+_fork_hook_registered = False
+
+
+def _reset_after_fork():
+    for engine in list(_fork_engines):
+        engine.dispose(close=False)
+
+
+def dispose_after_fork(engines):
+    # a forked worker must not reuse connections opened by the parent (e.g. at import with --preload):
+    # drop them from the child's pools without closing the sockets the parent still owns. One fork hook
+    # per process covers the engines of every app created in it.
+    global _fork_hook_registered
+    _fork_engines.update(engines)
+    if not _fork_hook_registered:
+        os.register_at_fork(after_in_child=_reset_after_fork)
+        _fork_hook_registered = True
+
+
+class PoolStats:
+    # checkout counts, new connections, invalidations, checkout waits and timeouts per engine, plus the
+    # pool's current occupancy. Per worker process, like RequestMetrics.
+
+    def __init__(self):
+        self._engines = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def watch(self, engine, name):
+        self._engines[name] = engine
+        self._counters[name] = {"checkouts": 0, "connects": 0, "invalidated": 0, "timeouts": 0,
+                                "wait_seconds": 0.0, "max_wait_seconds": 0.0}
+        event.listen(engine, "checkout", lambda *args: self._count(name, "checkouts"))
+        event.listen(engine, "connect", lambda *args: self._count(name, "connects"))
+        event.listen(engine, "invalidate", lambda *args: self._count(name, "invalidated"))
+        if isinstance(engine.pool, TimedQueuePool):
+            engine.pool.wait_observer = lambda seconds, timed_out=False: self._waited(name, seconds, timed_out)
+
+    def _count(self, name, key):
+        with self._lock:
+            self._counters[name][key] += 1
+
+    def _waited(self, name, seconds, timed_out):
+        with self._lock:
+            counters = self._counters[name]
+            if timed_out:
+                counters["timeouts"] += 1
+                return
+            counters["wait_seconds"] += seconds
+            counters["max_wait_seconds"] = max(counters["max_wait_seconds"], seconds)
+
+    def stats(self):
+        result = {}
+        with self._lock:
+            for name, engine in self._engines.items():
+                pool = engine.pool
+                snapshot = dict(self._counters[name], pool=type(pool).__name__)
+                if isinstance(pool, QueuePool):
+                    snapshot.update(size=pool.size(), checked_out=pool.checkedout(), idle=pool.checkedin(),
+                                    overflow=max(pool.overflow(), 0))
+                result[name] = snapshot
+        return result
+
+    def prometheus(self):
+        lines = []
+        series = (("shop_db_pool_checkouts_total", "counter", "checkouts"),
+                  ("shop_db_pool_connects_total", "counter", "connects"),
+                  ("shop_db_pool_invalidated_total", "counter", "invalidated"),
+                  ("shop_db_pool_timeouts_total", "counter", "timeouts"),
+                  ("shop_db_pool_wait_seconds_total", "counter", "wait_seconds"),
+                  ("shop_db_pool_checked_out", "gauge", "checked_out"),
+                  ("shop_db_pool_idle", "gauge", "idle"),
+                  ("shop_db_pool_overflow", "gauge", "overflow"))
+        stats = self.stats()
+        for metric, kind, key in series:
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for name, snapshot in sorted(stats.items()):
+                if key in snapshot:
+                    lines.append('%s{engine="%s"} %s' % (metric, name, snapshot[key]))
+        return "\n".join(lines) + "\n"
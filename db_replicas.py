@@ -0,0 +1,89 @@
+import itertools
+import os
+import sqlite3
+import time
+from functools import wraps
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+
+from db_pool import engine_options
+
+STICKY_COOKIE = "primary_until"
+
+
+def replica_binds(uris, environ=os.environ):
+    # SQLALCHEMY_BINDS entries "replica1", "replica2", ... for a comma separated DB_REPLICA_URIS, with the
+    # same pool settings as the primary. No model is bound to them; RoutingSession sends reads there.
+    binds = {}
+    for number, uri in enumerate([uri.strip() for uri in uris.split(",") if uri.strip()], 1):
+        binds["replica%d" % number] = dict(engine_options(uri, environ), url=uri)
+    return binds
+
+
+class RoutingSession(Session):
+    # flask_sqlalchemy's session, except that inside a @ReplicaRouter.reads view everything but flushes and
+    # INSERT/UPDATE/DELETE goes to the replica picked for the request. Outside a request (CLI, payment
+    # and import pools) and in every other view it behaves exactly like the stock session.
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or getattr(clause, "is_dml", False):
+                g.db_wrote = True
+            elif g.get("replica_engine") is not None:
+                return g.replica_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class ReplicaRouter:
+    # Picks a replica per request (round robin) for views marked with @reads. A browser that has just
+    # written something (a flush or DML statement on the primary) gets a STICKY_COOKIE and reads from
+    # the primary for sticky_seconds, so it sees its own writes even while the replicas lag behind.
+    # sticky_seconds should be longer than the worst replication lag you expect.
+
+    def __init__(self, sticky_seconds=5):
+        self.sticky_seconds = sticky_seconds
+        self.names = []
+        self.engines = []
+        self._next = None
+
+    def init_app(self, app, db):
+        # after db.init_app(app): the replicas are that app's "replica*" binds
+        with app.app_context():
+            self.names = sorted(key for key in db.engines if key and key.startswith("replica"))
+            self.engines = [db.engines[name] for name in self.names]
+        self._next = itertools.cycle(range(len(self.engines))) if self.engines else None
+        app.after_request(self._mark_writer)
+
+    def reads(self, view):
+        @wraps(view)
+        def replica_view(*args, **kwargs):
+            if self._next is not None and not request.cookies.get(STICKY_COOKIE):
+                g.replica_engine = self.engines[next(self._next)]
+            try:
+                return view(*args, **kwargs)
+            finally:
+                g.replica_engine = None
+        return replica_view
+
+    def _mark_writer(self, response):
+        if self._next is not None and g.get("db_wrote"):
+            response.set_cookie(STICKY_COOKIE, str(int(time.time() + self.sticky_seconds)),
+                                max_age=self.sticky_seconds, httponly=True, samesite="Lax")
+        return response
+
+
+def copy_sqlite(primary, replicas):
+    # for development and benchmarks: SQLite files standing in for replicas, refreshed from the primary
+    # with sqlite3's online backup (a real deployment uses the database's own replication)
+    source = sqlite3.connect(primary.url.database)
+    try:
+        for replica in replicas:
+            target = sqlite3.connect(replica.url.database)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+            replica.dispose()
+    finally:
+        source.close()
@@ -4,8 +4,21 @@ from wtforms import StringField,PasswordField,SubmitField,IntegerField,DecimalFi
 from wtforms.validators import DataRequired,Email
 
 
+class LazyEmail:
+    # wtforms' Email() imports email_validator when it is created, i.e. when this module is imported;
+    # this builds it on the first validation instead, so worker boot doesn't pay for it
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.validator = None
+
+    def __call__(self, form, field):
+        if self.validator is None:
+            self.validator = Email(**self.kwargs)
+        return self.validator(form, field)
+
+
 class LoginForm(FlaskForm):
-    email = StringField("Email", validators=[DataRequired(), Email()])
+    email = StringField("Email", validators=[DataRequired(), LazyEmail()])
     password = PasswordField("Password", validators=[DataRequired()])
     submit = SubmitField("Login")
 
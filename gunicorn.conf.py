@@ -0,0 +1,55 @@
+# gunicorn settings, read automatically from the working directory (the Procfile also passes it explicitly).
+# Everything can be overridden from the environment:
+#
+#   GUNICORN_WORKER_CLASS  gthread (default), gevent or sync
+#   WEB_CONCURRENCY        worker processes; default depends on the class and the CPU count
+#   GUNICORN_THREADS       threads per gthread worker (default 4)
+#   GUNICORN_CONNECTIONS   concurrent requests per gevent worker (default 200)
+#   GUNICORN_TIMEOUT       seconds before a stuck worker is killed (default 30)
+#   GUNICORN_PRELOAD       1 to import the app once in the master before forking (default 1)
+#
+# Slow I/O (payments, invoice pdfs, image variants) already runs on background pools and the request
+# waits a bounded time for it, so gthread is enough for most deployments. gevent also needs
+# `pip install gevent psycogreen` for Postgres.
+import logging
+import multiprocessing
+import os
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+cpus = multiprocessing.cpu_count()
+
+if worker_class == "gevent":
+    # must happen before the app (and its thread pools, locks and sockets) is imported by preload_app
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()  # otherwise every Postgres query blocks the whole worker
+    except ImportError:
+        logging.getLogger("gunicorn.error").warning("psycogreen is not installed; Postgres queries will block gevent workers")
+    default_workers = cpus
+elif worker_class == "gthread":
+    default_workers = cpus + 1
+else:
+    default_workers = cpus * 2 + 1
+
+workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+threads = int(os.environ.get("GUNICORN_THREADS", 4)) if worker_class == "gthread" else 1
+worker_connections = int(os.environ.get("GUNICORN_CONNECTIONS", 200))
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8000")
+
+# creating the app once (main:create_app()) and forking shares its memory and catches import errors before any
+# worker starts; every worker still opens its own database connections (db_pool.dispose_after_fork)
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+# on deploy/restart workers get this long to finish in-flight requests (and pending payments) before being killed
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# recycle workers now and then so a slow leak can't grow forever; jitter keeps them from restarting together
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG")  # "-" for stdout
@@ -0,0 +1,65 @@
+import hashlib
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import make_response, request, session
+
+
+class ConditionalPages:
+    # ETag / Last-Modified for catalog pages. The tag covers everything the page is built from:
+    # the catalog version (bumped by product/brand/category writes), the url, the per-user bits of
+    # the header (user_key) and a ttl window, so stock changes from checkouts still show up eventually.
+    # A matching If-None-Match gets a 304 before the view runs, so no queries and no rendering.
+    # public=True is for responses that are the same for everyone (user_key=None): shared caches may
+    # keep them too, and the session is never touched, so there is no Vary: Cookie. Those pages also
+    # answer If-Modified-Since (when there is no If-None-Match). Per-user pages don't: a date can't
+    # tell that the header's cart count or login state changed, only the tag can.
+
+    def __init__(self, catalog, user_key=None, ttl=60, public=False):
+        self.catalog = catalog  # a VersionedCache; its version/changed_at describe the catalog
+        self.user_key = user_key
+        self.ttl = ttl
+        self.public = public
+
+    def etag(self):
+        window = int(time.time() // self.ttl)
+        key = "%s|%s|%s|%s" % (self.catalog.version, window, request.full_path, self.user_key() if self.user_key else "")
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def last_modified(self):
+        # the later of the last catalog write and the start of the ttl window, so a date-only
+        # revalidation expires with the window just like the tag does
+        window_start = time.time() // self.ttl * self.ttl
+        return datetime.fromtimestamp(int(max(self.catalog.changed_at, window_start)), timezone.utc)
+
+    def not_modified(self, tag, modified):
+        if request.if_none_match:
+            return request.if_none_match.contains(tag)
+        return self.public and request.if_modified_since is not None and modified <= request.if_modified_since
+
+    def __call__(self, view):
+        @wraps(view)
+        def conditional_view(*args, **kwargs):
+            # pending flash messages are shown once, so that page can't be answered from the browser cache
+            if request.method != "GET" or (not self.public and session.get("_flashes")):
+                return view(*args, **kwargs)
+
+            tag = self.etag()
+            modified = self.last_modified()
+            if self.not_modified(tag, modified):
+                response = make_response("", 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(tag)
+            response.last_modified = modified
+            # browsers (and for public pages, shared caches) may keep it but must check back
+            if self.public:
+                response.cache_control.public = True
+            else:
+                response.cache_control.private = True  # per-user page
+            response.cache_control.no_cache = True
+            return response
+        return conditional_view
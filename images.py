@@ -0,0 +1,115 @@
+import hashlib
+import logging
+import os
+import secrets
+import threading
+
+from concurrency import cpu_executor
+
+logger = logging.getLogger(__name__)
+
+ALLOWED_EXTENSIONS = (".jpg", ".jpeg", ".gif", ".png")
+
+# longest side in px; pick the smallest variant at least as big as the box the template draws
+VARIANT_SIZES = (128, 320, 640)
+
+
+class ImagePipeline:
+    # Uploads are stored under a name derived from their content, so the same file uploaded twice
+    # is kept once and a URL never changes meaning (safe to cache forever). Resized WebP copies are
+    # made on a thread pool after the request has returned; the original is the fallback until then:
+    #   <hash>.jpg  ->  <hash>-128.webp, <hash>-320.webp, <hash>-640.webp
+
+    def __init__(self, root, max_workers=2, sizes=VARIANT_SIZES):
+        self.root = root
+        self.sizes = sizes
+        self._pool = cpu_executor(max_workers, "images")
+        self._known = set()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def allowed(filename):
+        return filename.lower().endswith(ALLOWED_EXTENSIONS)
+
+    def store(self, file_storage, filename, unique=False):
+        # filename is the (secured) upload name, only used for its extension.
+        # unique=True adds a random suffix, for columns that can't share a file between rows.
+        return self.store_bytes(file_storage.read(), filename, unique)
+
+    def store_bytes(self, data, filename, unique=False):
+        ext = os.path.splitext(filename)[1].lower()
+        name = hashlib.sha256(data).hexdigest()[:20]
+        if unique:
+            name += "-" + secrets.token_hex(4)
+        name += ext
+
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            with open(path, "wb") as out:
+                out.write(data)
+        self._pool.submit(self._make_variants, name)
+        return name
+
+    def variant_name(self, name, size, webp=True):
+        # webp=False names the same-format copies older versions also wrote; only delete() still looks for them
+        stem, ext = os.path.splitext(name)
+        if webp:
+            ext = ".webp"
+        elif ext == ".gif":
+            ext = ".png"  # only the first frame is resized
+        return "%s-%d%s" % (stem, size, ext)
+
+    def variant(self, name, size):
+        # the best existing file for a box of `size` px; the original until the variants are ready
+        fitting = [s for s in self.sizes if s >= size]
+        if not fitting:
+            return name
+        candidate = self.variant_name(name, fitting[0])
+        if candidate in self._known:
+            return candidate
+        if os.path.exists(os.path.join(self.root, candidate)):
+            with self._lock:
+                self._known.add(candidate)
+            return candidate
+        return name
+
+    def delete(self, name):
+        names = [name] + [self.variant_name(name, size, webp) for size in self.sizes for webp in (True, False)]
+        for victim in names:
+            with self._lock:
+                self._known.discard(victim)
+            try:
+                os.unlink(os.path.join(self.root, victim))
+            except FileNotFoundError:
+                pass
+
+    def rebuild(self):
+        # synchronous, for the CLI backfill of images uploaded before the pipeline existed
+        count = 0
+        for name in sorted(os.listdir(self.root)):
+            stem = os.path.splitext(name)[0]
+            if self.allowed(name) and stem.rsplit("-", 1)[-1] not in {str(size) for size in self.sizes}:
+                self._make_variants(name)
+                count += 1
+        return count
+
+    def _make_variants(self, name):
+        # Pillow is only needed here, on the background pool; importing it lazily keeps it out of worker boot
+        from PIL import Image, ImageOps
+        try:
+            with Image.open(os.path.join(self.root, name)) as original:
+                original = ImageOps.exif_transpose(original)
+                for size in self.sizes:
+                    path = os.path.join(self.root, self.variant_name(name, size))
+                    if os.path.exists(path):
+                        continue
+                    image = original.copy()
+                    image.thumbnail((size, size))
+                    if image.mode == "P":
+                        image = image.convert("RGBA")
+                    # write and rename so variant() never picks up a half-written file
+                    image.save(path + ".tmp", format="WEBP", quality=80)
+                    os.replace(path + ".tmp", path)
+        except Exception:
+            logger.exception("could not build image variants for %s", name)
@@ -0,0 +1,126 @@
+import html.parser
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceRenderer:
+    # Renders invoice PDFs on a small thread pool and keeps them on disk, one file per key.
+    # Callers pick a key that changes whenever the rendered content would (invoice + order status),
+    # so a cached file never needs invalidating.
+
+    def __init__(self, cache_dir, wkhtmltopdf=None, max_workers=2):
+        self.cache_dir = cache_dir
+        self.wkhtmltopdf = wkhtmltopdf or shutil.which("wkhtmltopdf")
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="invoice-pdf")
+        self._pending = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pdf")
+
+    def cached(self, key):
+        path = self.path(key)
+        return path if os.path.exists(path) else None
+
+    def submit(self, key, html_page):
+        # one render per key at a time; repeat requests while it runs share the same future
+        with self._lock:
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pool.submit(self._render, key, html_page)
+                self._pending[key] = future
+                future.add_done_callback(lambda done: self._forget(key))
+            return future
+
+    def _forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _render(self, key, html_page):
+        if self.wkhtmltopdf:
+            import pdfkit
+            config = pdfkit.configuration(wkhtmltopdf=self.wkhtmltopdf)
+            pdf = pdfkit.from_string(html_page, configuration=config, options={"enable-local-file-access": "", "quiet": ""})
+        else:
+            pdf = text_pdf(html_text(html_page))
+
+        # write next to the final file and rename, so a reader never sees half a PDF
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(pdf)
+        os.replace(tmp_path, self.path(key))
+        logger.info("rendered invoice %s", key)
+        return self.path(key)
+
+
+class _TextExtractor(html.parser.HTMLParser):
+    BLOCKS = {"p", "div", "br", "tr", "h1", "h2", "h3", "h4", "h5", "hr", "table"}
+    SKIP = {"script", "style", "head", "title"}
+
+    def __init__(self):
+        super().__init__()
+        self.lines = [""]
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip += 1
+        elif tag in self.BLOCKS:
+            self.lines.append("")
+        elif tag in ("td", "th"):
+            self.lines[-1] += "\t"
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skip -= 1
+        elif tag in self.BLOCKS:
+            self.lines.append("")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.lines[-1] += re.sub(r"\s+", " ", data)
+
+
+def html_text(html_page):
+    parser = _TextExtractor()
+    parser.feed(html_page)
+    # collapse whitespace but keep table cells apart
+    lines = (re.sub(r" *\t[ \t]*", "\t", line).strip() for line in parser.lines)
+    return [line.replace("\t", "    ") for line in lines if line]
+
+
+def text_pdf(lines, lines_per_page=50):
+    # Minimal PDF writer (Helvetica, A4) used when wkhtmltopdf isn't installed.
+    def escape(text):
+        text = text.encode("latin-1", "replace").decode("latin-1")
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for page in pages:
+        stream = "BT /F1 11 Tf 50 800 Td 15 TL " + " ".join("(%s) '" % escape(line) for line in page) + " ET"
+        objects.append("<< /Length %d >>\nstream\n%s\nendstream" % (len(stream.encode("latin-1")), stream))
+        objects.append("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                       "/Resources << /Font << /F1 3 0 R >> >> >>" % len(objects))
+        kids.append("%d 0 R" % len(objects))
+    objects[1] = "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += ("%d 0 obj\n%s\nendobj\n" % (number, body)).encode("latin-1")
+    xref = len(out)
+    out += ("xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)).encode("latin-1")
+    out += "".join("%010d 00000 n \n" % offset for offset in offsets).encode("latin-1")
+    out += ("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%EOF\n" % (len(objects) + 1, xref)).encode("latin-1")
+    return bytes(out)
@@ -1,41 +1,139 @@
-from flask import make_response,Flask,render_template,request,redirect,url_for,flash,session
+from flask import make_response,Flask,Blueprint,current_app,render_template,request,redirect,url_for,flash,session,jsonify,send_file,abort,Response,stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_bootstrap import Bootstrap5 #pip install bootstrap-flask
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash,check_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_login import LoginManager,UserMixin,login_user,login_required,logout_user,current_user
-import email_validator
 from forms import LoginForm,BrandForm,CategoryForm,UpdateBrandForm,UpdateCategoryForm
-from datetime import date,datetime
-from sqlalchemy.orm import relationship
+from catalog_cache import VersionedCache
+from http_cache import ConditionalPages
+from markupsafe import Markup
+from search import ProductSearch
+from checkout import Checkout,InsufficientStock,InvalidQuantity
+from cart_store import MemoryCartStore,SqlCartStore
+from pricing import price_items,order_totals
+import order_lines
+from analytics import SalesRollups
+from catalog_import import ProductImporter,read_rows,export_lines
+from catalog_api import CatalogApi,ApiError
+import zipfile
+from pagination import keyset_paginate,keyset_query
+import schema
+from invoices import InvoiceRenderer
+from concurrent.futures import TimeoutError
+from images import ImagePipeline
+import query_plans
+from metrics import RequestMetrics
+from db_pool import engine_options,dispose_after_fork,PoolStats
+from db_replicas import RoutingSession,ReplicaRouter,replica_binds,copy_sqlite
+import static_assets
+import click
+from datetime import date,datetime,timedelta
+from decimal import Decimal
+from sqlalchemy.orm import relationship,joinedload,deferred
 import os
 import secrets
 import json
+import csv
 from functools import wraps
-import pdfkit
-import stripe
+from payments import PaymentProcessor,StripeGateway,FakeGateway,PaymentFailed
+from passwords import PasswordHasher,LoginThrottle,HashingBusy,Throttled
 
 
 publishable_key=os.environ.get("PUBLISH_KEY")
-stripe.api_key=os.environ.get("API_KEY")
+ROOT=os.path.dirname(os.path.abspath(__file__))
 
+# everything below is created at import without touching the database or the app; create_app() wires it together.
+# all routes, hooks and cli commands live on this blueprint, so their endpoints are "shop.<view>"
+shop=Blueprint("shop",__name__,cli_group=None)
 
-app=Flask(__name__)
-app.config["SECRET_KEY"]=os.environ.get("FLASK_KEY")
+bootstrap=Bootstrap5()
+db=SQLAlchemy(session_options={"class_":RoutingSession})
+replicas=ReplicaRouter(sticky_seconds=int(os.environ.get("REPLICA_STICKY_SECONDS",5)))
+pool_stats=PoolStats()
+login_manager=LoginManager()
 
-bootstrap=Bootstrap5(app)
+# scrypt runs in HASH_WORKERS processes per web worker (0: inline), HASH_QUEUE more may wait, the rest get a 503.
+# PASSWORD_HASH_METHOD sets the cost ("scrypt:N:r:p" or "pbkdf2:sha256:iterations"); older hashes are upgraded at login
+password_hasher=PasswordHasher(os.environ.get("PASSWORD_HASH_METHOD","scrypt:32768:8:1"),max_workers=int(os.environ.get("HASH_WORKERS",1)),
+                               max_pending=int(os.environ.get("HASH_QUEUE",8)),wait_seconds=float(os.environ.get("HASH_WAIT_SECONDS",5)))
+# attempts per address and failed logins per account in each LOGIN_THROTTLE_WINDOW seconds, per worker process
+login_throttle=LoginThrottle(per_ip=int(os.environ.get("LOGIN_ATTEMPTS_PER_IP",30)),per_account=int(os.environ.get("LOGIN_FAILURES_PER_ACCOUNT",5)),
+                             window=int(os.environ.get("LOGIN_THROTTLE_WINDOW",300)))
 
-db=SQLAlchemy()
-app.config["SQLALCHEMY_DATABASE_URI"]=os.environ.get("DB_URI","sqlite:///myshop.db")
-db.init_app(app)
+# WKHTMLTOPDF points at the wkhtmltopdf binary; without it (or one on PATH) invoices fall back to a plain-text pdf
+invoice_renderer=InvoiceRenderer(os.environ.get("INVOICE_CACHE_DIR",os.path.join(ROOT,"instance","invoices")),
+                                 wkhtmltopdf=os.environ.get("WKHTMLTOPDF"),max_workers=int(os.environ.get("PDF_WORKERS",2)))
+PDF_WAIT_SECONDS=float(os.environ.get("PDF_WAIT_SECONDS",1))
 
-login_manager=LoginManager()
-login_manager.init_app(app)
+# logs a warning for any request running more than QUERY_BUDGET statements, to catch N+1 regressions
+request_metrics=RequestMetrics(query_budget=int(os.environ.get("QUERY_BUDGET",20)))
+
+product_images=ImagePipeline(os.path.join(ROOT,"static","images","products"),max_workers=int(os.environ.get("IMAGE_WORKERS",2)))
+profile_images=ImagePipeline(os.path.join(ROOT,"static","images","profile_pic"),max_workers=1)
+
+
+@shop.app_template_global()
+def product_image(filename,size):
+    # url of the smallest resized webp that covers a size x size box, or the original until it has been made
+    return url_for("static",filename="images/products/"+product_images.variant(filename,size))
+
+
+# fingerprinted, precompressed css/js once "flask build-assets" has run; templates link them with asset_url()
+assets=static_assets.StaticAssets()
+
+
+@shop.after_app_request
+def cache_images(response):
+    # uploaded images are never overwritten under the same name, so browsers can keep them forever
+    if request.endpoint=="static" and request.path.startswith("/static/images/") and response.status_code==200:
+        response.cache_control.no_cache=None
+        response.cache_control.public=True
+        response.cache_control.max_age=31536000
+        response.cache_control.immutable=True
+    return response
+
+# brand/category lists for the navigation bar
+catalog_cache=VersionedCache(ttl=int(os.environ.get("CATALOG_CACHE_TTL",60)))
+# product counts shown under the listings; checkouts only age out with the ttl
+listing_counts=VersionedCache(ttl=int(os.environ.get("LISTING_COUNT_TTL",300)))
+# rendered product grids keyed by url; its version is the catalog version the page ETags are built from.
+# all three are dropped together by catalog_changed()
+page_fragments=VersionedCache(ttl=int(os.environ.get("PAGE_CACHE_TTL",60)),max_entries=5000)
+# ETag/304 for the catalog pages; the cart count in the navigation bar is the only per-user part besides the user
+conditional_page=ConditionalPages(page_fragments,lambda: (current_user.get_id(),session.get("cart_count",0)),ttl=page_fragments.ttl)
+
+
+def catalog_changed():
+    # every product/brand/category write: nav lists, counts, grids and page ETags all move on
+    catalog_cache.invalidate()
+    listing_counts.invalidate()
+    page_fragments.invalidate()
+
+
+# USER_CACHE_TTL seconds of logged-in users per worker, so authenticated requests usually skip the user query
+user_cache=VersionedCache(ttl=int(os.environ.get("USER_CACHE_TTL",30)),max_entries=10000)
+
+
+class LoggedInUser(UserMixin):
+    # what a request needs to know about its user; a plain object so it can be cached across requests and threads
+
+    def __init__(self,id,username,email,first_name,last_name):
+        self.id=id
+        self.username=username
+        self.email=email
+        self.first_name=first_name
+        self.last_name=last_name
+
+
+def load_logged_in_user(user_id):
+    row=db.session.execute(db.select(User.id,User.username,User.email,User.first_name,User.last_name).where(User.id==user_id)).first()
+    return LoggedInUser(**row._mapping) if row else None
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.execute(db.select(User).where(User.id==user_id)).scalar()
+    return user_cache.get(int(user_id),lambda: load_logged_in_user(int(user_id)))
 
 
 class User(UserMixin,db.Model):
@@ -52,6 +150,13 @@ class User(UserMixin,db.Model):
     profile_pic=db.Column(db.String(150),unique=True,nullable=False)
 
 
+@db.event.listens_for(User,"after_update")
+@db.event.listens_for(User,"after_delete")
+def forget_cached_user(mapper,connection,target):
+    # any profile change or deletion through the ORM
+    user_cache.forget(target.id)
+
+
 class Brand(db.Model):
     __tablename__="brands"
     id=db.Column(db.Integer,primary_key=True)
@@ -67,6 +172,13 @@ class Category(db.Model):
 
 
 class Product(db.Model):
+    __table_args__=(
+        # home(): in-stock products, newest first
+        db.Index("ix_product_in_stock","id",sqlite_where=db.text("stock > 0"),postgresql_where=db.text("stock > 0")),
+        # get_brand()/get_category() listings
+        db.Index("ix_product_brand","brand_id","id"),
+        db.Index("ix_product_category","category_id","id"),
+    )
     id=db.Column(db.Integer,primary_key=True)
     name=db.Column(db.String(100),nullable=False,unique=True)
     price=db.Column(db.Numeric(10,2),nullable=False)
@@ -85,6 +197,7 @@ class Product(db.Model):
 
 class ItemsDict(db.TypeDecorator):
     impl = db.Text
+    cache_ok = True
 
     def process_bind_param(self, value, dialect):
         if value is None:
@@ -94,243 +207,624 @@ class ItemsDict(db.TypeDecorator):
 
     def process_result_value(self,value,dialect):
         if value is None:
-            return "{}"
+            return {}
         else:
             return json.loads(value)
 
 
+class CartLine(db.Model):
+    __tablename__="cart_lines"
+    __table_args__=(
+        # SqlCartStore.lines(): a cart's lines in the order they were added, without a sort step
+        db.Index("ix_cart_lines_added","cart_id","added_at","product_id"),
+    )
+    cart_id=db.Column(db.String(32),primary_key=True)
+    product_id=db.Column(db.Integer,primary_key=True)
+    quantity=db.Column(db.Integer,nullable=False)
+    color=db.Column(db.String(50))
+    added_at=db.Column(db.DateTime,nullable=False,default=datetime.utcnow)
+
+
 class Order(db.Model):
     id=db.Column(db.Integer,primary_key=True)
     invoice=db.Column(db.String(20),unique=True,nullable=False)
     status=db.Column(db.String(20),nullable=False,default="pending")
     date_created=db.Column(db.DateTime,nullable=False,default=datetime.utcnow)
     customer_id=db.Column(db.Integer,nullable=False)
-    items=db.Column(ItemsDict)
+    # json cart of orders placed before order_lines existed; deferred so loading an order doesn't parse it
+    items=deferred(db.Column(ItemsDict))
+    lines=relationship("OrderLine",order_by="OrderLine.product_id",lazy="select")
+    # priced once at checkout; NULL on orders placed before totals were stored
+    amount=db.Column(db.Numeric(10,2),nullable=True)
+    tax=db.Column(db.Numeric(10,2),nullable=True)
+    total=db.Column(db.Numeric(10,2),nullable=True)
+
+
+class OrderLine(db.Model):
+    __tablename__="order_lines"
+    order_id=db.Column(db.Integer,db.ForeignKey("order.id"),primary_key=True)
+    product_id=db.Column(db.Integer,primary_key=True)
+    # name and price as they were at checkout; the product may have changed or gone since
+    name=db.Column(db.String(250),nullable=False)
+    quantity=db.Column(db.Integer,nullable=False)
+    unit_price=db.Column(db.Numeric(10,2),nullable=False)
+    discount=db.Column(db.Integer,nullable=False,default=0)
+    color=db.Column(db.String(50))
+    line_total=db.Column(db.Numeric(10,2),nullable=False)
+
+
+# rollups behind the admin analytics; see analytics.SalesRollups
+class DailySales(db.Model):
+    __tablename__="sales_daily"
+    day=db.Column(db.Date,primary_key=True)
+    status=db.Column(db.String(20),primary_key=True)
+    orders=db.Column(db.Integer,nullable=False,default=0)
+    revenue=db.Column(db.Numeric(12,2),nullable=False,default=0)
+
+
+class DailyProductSales(db.Model):
+    __tablename__="sales_daily_product"
+    day=db.Column(db.Date,primary_key=True)
+    product_id=db.Column(db.Integer,primary_key=True)
+    units=db.Column(db.Integer,nullable=False,default=0)
+    revenue=db.Column(db.Numeric(12,2),nullable=False,default=0)
+
+
+product_search=ProductSearch(db,Product)
+product_importer=ProductImporter(db,Product,Brand,Category,product_images,product_search,
+                                 batch_size=int(os.environ.get("IMPORT_BATCH_SIZE",500)),max_workers=int(os.environ.get("IMPORT_WORKERS",4)))
+sales_rollups=SalesRollups(db,Order,OrderLine,Product,Brand,Category,DailySales,DailyProductSales)
+checkout=Checkout(db,Product,Order,OrderLine,sales=sales_rollups)
+catalog_api=CatalogApi(db,Product,Brand,Category)
+# the JSON catalog is the same for every caller, so edge caches may share it; it moves with the page ETags
+api_conditional=ConditionalPages(page_fragments,ttl=page_fragments.ttl,public=True)
+# PAYMENT_GATEWAY=fake charges in-process (FAKE_GATEWAY_LATENCY seconds each), for load tests and offline runs
+if os.environ.get("PAYMENT_GATEWAY","stripe")=="fake":
+    payment_gateway=FakeGateway(latency=float(os.environ.get("FAKE_GATEWAY_LATENCY",0.2)))
+else:
+    payment_gateway=StripeGateway(os.environ.get("API_KEY"),timeout=int(os.environ.get("STRIPE_TIMEOUT",10)))
+payments=PaymentProcessor(db,Order,payment_gateway,sales=sales_rollups,max_workers=int(os.environ.get("PAYMENT_WORKERS",4)))
+PAYMENT_WAIT_SECONDS=float(os.environ.get("PAYMENT_WAIT_SECONDS",5))
+# CART_STORE=memory keeps carts in the worker process; only meant for tests and single-worker runs
+cart_store=MemoryCartStore() if os.environ.get("CART_STORE","sql")=="memory" else SqlCartStore(db,CartLine)
+
+
+def create_app(config=None):
+    # config: overrides for app.config, applied before the database is set up (tests, benchmarks).
+    # Nothing here connects to the database; run "flask --app main migrate" to create or upgrade the schema
+    app=Flask(__name__)
+    app.config["SECRET_KEY"]=os.environ.get("FLASK_KEY")
+    app.config["SQLALCHEMY_DATABASE_URI"]=os.environ.get("DB_URI","sqlite:///myshop.db")
+    # DB_REPLICA_URIS: comma separated read replicas for the catalog pages (@replicas.reads); everything else uses DB_URI
+    app.config["SQLALCHEMY_BINDS"]=replica_binds(os.environ.get("DB_REPLICA_URIS",""))
+    app.config.update(config or {})
+    # pool size, overflow, timeouts, recycle and pre-ping from DB_POOL_* / DB_* env vars; see db_pool.engine_options
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS",engine_options(app.config["SQLALCHEMY_DATABASE_URI"]))
+    # PROXY_HOPS: reverse proxies in front of gunicorn, so request.remote_addr (login throttling) is the client's address
+    if int(os.environ.get("PROXY_HOPS",0)):
+        app.wsgi_app=ProxyFix(app.wsgi_app,x_for=int(os.environ["PROXY_HOPS"]),x_proto=int(os.environ["PROXY_HOPS"]))
+
+    bootstrap.init_app(app)
+    db.init_app(app)
+    replicas.init_app(app,db)
+    with app.app_context():
+        pool_stats.watch(db.engine,"primary")
+        for name,engine in zip(replicas.names,replicas.engines):
+            pool_stats.watch(engine,name)
+        dispose_after_fork(list(db.engines.values()))
+    login_manager.init_app(app)
+    request_metrics.init_app(app)
+    assets.init_app(app)
+    app.register_blueprint(shop)
+    return app
+
+
+def migrate():
+    # creates missing tables, columns and indexes and the search index; needs an app context
+    schema.upgrade(db)
+    product_search.ensure_index()
+
+
+@shop.cli.command("migrate")
+def migrate_command():
+    # run on deploy before the new workers start (the Procfile's release step), and once on a new database
+    migrate()
+    print("Database schema is up to date.")
+
+
+@shop.cli.command("build-image-variants")
+def build_image_variants():
+    count=product_images.rebuild()+profile_images.rebuild()
+    print(f"Processed {count} images.")
+
+
+def route_queries():
+    # the lookups each request path makes, with sample values; listings and the cart come from the same helpers
+    # the routes call, so the two can't drift apart. The nav and admin lists read whole tables on purpose
+    return {
+        "home":keyset_query(listing_query(Product.stock>0),Product.id),
+        "home next page":keyset_query(listing_query(Product.stock>0),Product.id,after=100),
+        "home count":listing_count_query(Product.stock>0),
+        "product_details":db.select(Product).where(Product.id==1),
+        "get_brand":keyset_query(listing_query(Product.brand_id==1),Product.id),
+        "get_brand count":listing_count_query(Product.brand_id==1),
+        "get_category":keyset_query(listing_query(Product.category_id==1),Product.id),
+        "get_category previous page":keyset_query(listing_query(Product.category_id==1),Product.id,before=100),
+        "get_category count":listing_count_query(Product.category_id==1),
+        "load_user":db.select(User.id,User.username,User.email,User.first_name,User.last_name).where(User.id==1),
+        "login":db.select(User).where(User.email=="someone@example.com"),
+        "cart":SqlCartStore(db,CartLine).lines_query("cart"),
+        "make_order":db.update(Product).where(Product.id.in_([1,2]),Product.stock>=1).values(stock=Product.stock-1),
+        "order_details":db.select(Order).where((Order.customer_id==1) & (Order.invoice=="invoice")),
+        "order_details lines":db.select(OrderLine).where(OrderLine.order_id==1),
+        "api products":keyset_query(catalog_api.select("products",["id","name","price"]).where(Product.brand_id==1),Product.id,per_page=20),
+        "api products ids":catalog_api.select("products",["id","name","price"]).where(Product.id.in_([1,2,3])),
+    }
+
+
+@shop.cli.command("check-query-plans")
+@click.option("--analyze",is_flag=True,help="Refresh planner statistics first.")
+def check_query_plans(analyze):
+    if analyze:
+        db.session.execute(db.text("ANALYZE"))
+        db.session.commit()
+    failures=query_plans.check(db,route_queries())
+    for name,plan in failures.items():
+        print(f"{name}: full table scan")
+        for line in plan:
+            print("    "+line)
+    if failures:
+        raise SystemExit(1)
+    print("All route queries use an index.")
+
+
+@shop.cli.command("backfill-order-lines")
+@click.option("--batch-size",default=500,show_default=True)
+def backfill_order_lines(batch_size):
+    # safe to run while the shop is up: orders without lines are still read from their json until moved
+    count=order_lines.backfill(db,Order,OrderLine,batch_size=batch_size)
+    print(f"Moved {count} orders to order_lines.")
+
+
+@shop.cli.command("rebuild-sales-rollups")
+@click.option("--since",type=click.DateTime(formats=["%Y-%m-%d"]),help="Only recompute from this day on.")
+def rebuild_sales_rollups(since):
+    # run once after backfill-order-lines, then e.g. nightly with --since to correct any drift
+    sales_rollups.rebuild(since.date() if since else None)
+    print("Sales rollups rebuilt.")
+
+
+@shop.cli.command("import-products")
+@click.argument("products",type=click.Path(exists=True,dir_okay=False))
+@click.option("--images",type=click.Path(exists=True,dir_okay=False),help="Zip archive with the images the rows name.")
+@click.option("--report",type=click.Path(dir_okay=False),help="Write the rows that failed to this CSV file.")
+def import_products(products,images,report):
+    # PRODUCTS: .csv with a header row, or .jsonl; columns as in catalog_import.COLUMNS
+    archive=zipfile.ZipFile(images) if images else None
+    try:
+        with open(products,"rb") as stream:
+            result=product_importer.run(read_rows(stream,products),archive)
+    finally:
+        if archive:
+            archive.close()
+    catalog_changed()
+    print(f"Imported {result.created} products, {len(result.errors)} rows failed.")
+    if report:
+        with open(report,"w",newline="") as out:
+            writer=csv.writer(out)
+            writer.writerow(["row","name","error"])
+            writer.writerows(result.errors)
+    else:
+        for number,name,message in result.errors:
+            print(f"row {number} ({name}): {message}")
 
 
-with app.app_context():
-    db.create_all()
+@shop.cli.command("export-products")
+@click.option("--format","fmt",type=click.Choice(["csv","jsonl"]),default="csv",show_default=True)
+@click.option("--output",type=click.File("w"),default="-")
+def export_products(fmt,output):
+    for line in export_lines(db,Product,Brand,Category,fmt):
+        output.write(line)
 
 
-def MergedItemsDict(dict1,dict2):
-    if isinstance(dict1,dict) and isinstance(dict2,dict):
-        items = dict(list(dict1.items()) + list(dict2.items()))
-        return items
-    return False
+@shop.cli.command("copy-to-replicas")
+def copy_to_replicas():
+    # SQLite stand-ins only: overwrite each replica file with the primary, e.g. after seeding a dev database
+    if not replicas.engines or any(engine.dialect.name!="sqlite" for engine in [db.engine]+replicas.engines):
+        raise click.ClickException("DB_URI and DB_REPLICA_URIS must all be sqlite files.")
+    copy_sqlite(db.engine,replicas.engines)
+    print(f"Copied the primary to {len(replicas.engines)} replica(s).")
+
+
+@shop.cli.command("build-assets")
+def build_assets():
+    # run on deploy, before the workers start
+    manifest=static_assets.build(current_app.static_folder)
+    print(f"Fingerprinted {len(manifest)} static files into static/{static_assets.OUTPUT_DIR}.")
+
+
+@shop.cli.command("purge-carts")
+@click.option("--days",default=30,show_default=True,help="Drop carts nothing was added to for this long.")
+def purge_carts(days):
+    # abandoned carts otherwise stay in cart_lines forever; run e.g. nightly
+    count=cart_store.purge(days)
+    print(f"Purged {count} lines from abandoned carts.")
+
 
+@shop.cli.command("reindex-search")
+def reindex_search():
+    count=product_search.reindex()
+    print(f"Indexed {count} products.")
 
-@app.route('/',methods=["GET","POST"])
+
+def nav_lists():
+    # plain rows instead of ORM objects so the cached lists outlive the session that loaded them
+    all_brands=catalog_cache.get("brands",lambda: db.session.execute(db.select(Brand.id,Brand.name)).all())
+    all_categories=catalog_cache.get("categories",lambda: db.session.execute(db.select(Category.id,Category.name)).all())
+    return all_brands,all_categories
+
+
+def load_cart():
+    # the session only carries the cart id; product data is joined in here with one query
+    if "cart_id" not in session:
+        return {}
+    lines=cart_store.lines(session["cart_id"])
+    if not lines:
+        return {}
+    products={product.id:product for product in db.session.execute(db.select(Product).where(Product.id.in_([int(key) for key in lines]))).scalars()}
+    shopping_cart={}
+    for key,line in lines.items():
+        product=products.get(int(key))
+        if product: # skip products deleted since they were added
+            shopping_cart[key]={"name":product.name,"price":str(product.price),"discount":product.discount,"quantity":line["quantity"],"color":line["color"],"image":product.image_1,"stock":product.stock,"colors":product.colors}
+    return shopping_cart
+
+
+def update_cart_count():
+    # kept in the session so the navigation bar doesn't need a query on every page
+    session["cart_count"]=len(cart_store.lines(session["cart_id"])) if "cart_id" in session else 0
+
+
+@shop.route('/',methods=["GET","POST"])
 def login():
     current_yr=date.today().year
     form=LoginForm()
     if form.validate_on_submit():
+        account=form.email.data.lower()
+        try:
+            login_throttle.check(request.remote_addr,account)
+        except Throttled as error:
+            flash("Too many login attempts. Please try again in a few minutes.")
+            return render_template("index.html",year=current_yr,form=form,is_error=True),429,{"Retry-After":str(error.retry_after)}
         user=db.session.execute(db.select(User).where(User.email==form.email.data)).scalar()
         if user:
-            if not check_password_hash(user.password,form.password.data):
+            try:
+                matches,new_hash=password_hasher.verify(user.password,form.password.data)
+            except HashingBusy:
+                flash("Too many people are logging in right now. Please try again in a moment.")
+                return render_template("index.html",year=current_yr,form=form,is_error=True),503,{"Retry-After":"5"}
+            if not matches:
+                login_throttle.failed(account)
                 flash("Sorry, wrong password. Pls try again.")
                 return render_template("index.html", year=current_yr,form=form, is_error=True)
             else:
+                if new_hash:
+                    # stored with an older cost or salt length
+                    user.password=new_hash
+                    db.session.commit()
+                login_throttle.succeeded(account)
                 login_user(user)
                 flash(f"Welcome, {user.username}! Your have successfully logged in.")
-                return redirect(url_for("home"))
+                return redirect(url_for("shop.home"))
         else:
+            login_throttle.failed(account)
             flash("Oops! Wrong email and password.")
             return render_template("index.html",year=current_yr,form=form,is_error=True)
     return render_template("index.html",form=form,year=current_yr)
 
 
-@app.route("/admin_page")
+@shop.route("/admin_page")
 def admin():
     current_yr = date.today().year
-    result=db.session.execute(db.select(Product))
-    all_products=list(result.scalars())
+    page=request.args.get("page",1,type=int)
+    # brand/category loaded in the same query so the table doesn't fire one lazy query per row
+    all_products=db.paginate(db.select(Product).options(joinedload(Product.brand_name),joinedload(Product.category_name)).order_by(Product.id),page=page,per_page=20)
 
-    all_categories = list(db.session.execute(db.select(Category).join(Product).where(Category.id == Product.category_id)).scalars())
+    all_categories=db.session.execute(db.select(Category.id,Category.name,db.func.count(Product.id).label("product_count")).join(Product).group_by(Category.id,Category.name).order_by(Category.name)).all()
 
-    result = db.session.execute(db.select(Brand).join(Product).where(Brand.id == Product.brand_id))
-    all_brands = list(result.scalars())
+    all_brands=db.session.execute(db.select(Brand.id,Brand.name,db.func.count(Product.id).label("product_count")).join(Product).group_by(Brand.id,Brand.name).order_by(Brand.name)).all()
 
     return render_template("admin.html",brands=all_brands,categories=all_categories,logged_in=current_user.is_authenticated,year=current_yr,products=all_products)
 
 
+@shop.route("/admin_page/cache_stats")
+@login_required
+def cache_stats():
+    return jsonify(catalog=catalog_cache.stats(),listing_counts=listing_counts.stats(),page_fragments=page_fragments.stats(),users=user_cache.stats())
+
+
+@shop.route("/admin_page/pool_stats")
+@login_required
+def db_pool_stats():
+    return jsonify(dict(pool_stats.stats(),password_hashing=password_hasher.stats()))
+
+
+@shop.route("/admin_page/sales")
+@login_required
+def sales_report():
+    # ?status=paid&limit=20
+    rows=order_lines.sales_by_product(db,Order,OrderLine,status=request.args.get("status"),limit=request.args.get("limit",50,type=int))
+    return jsonify(products=[{"product_id":row.product_id,"name":row.name,"units":row.units,"revenue":str(row.revenue),"orders":row.orders} for row in rows])
+
+
+def analytics_range():
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD, the last 30 days by default
+    end=request.args.get("end",type=date.fromisoformat) or datetime.utcnow().date()
+    start=request.args.get("start",type=date.fromisoformat) or end-timedelta(days=29)
+    return start,end
+
+
+@shop.route("/admin_page/analytics")
+@login_required
+def analytics():
+    start,end=analytics_range()
+    limit=request.args.get("limit",20,type=int)
+    rows=lambda statement: [{key:(str(value) if isinstance(value,(date,Decimal)) else value) for key,value in row._mapping.items()} for row in sales_rollups.rows(statement)]
+    return jsonify(start=str(start),end=str(end),
+                   days=rows(sales_rollups.daily(start,end)),
+                   status=rows(sales_rollups.by_status(start,end)),
+                   products=rows(sales_rollups.by_product(start,end,limit)),
+                   brands=rows(sales_rollups.by_brand(start,end,limit)),
+                   categories=rows(sales_rollups.by_category(start,end,limit)))
+
+
+@shop.route("/admin_page/analytics/<report>.csv")
+@login_required
+def analytics_csv(report):
+    reports={"days":sales_rollups.daily,"products":sales_rollups.by_product,"brands":sales_rollups.by_brand,"categories":sales_rollups.by_category}
+    if report not in reports:
+        abort(404)
+    start,end=analytics_range()
+    return Response(stream_with_context(sales_rollups.csv_lines(reports[report](start,end))),mimetype="text/csv",
+                    headers={"Content-Disposition":f"attachment; filename={report}-{start}-{end}.csv"})
+
+
+@shop.route("/admin_page/products/import",methods=["POST"])
+@login_required
+def import_products_upload():
+    # multipart form: "products" (.csv or .jsonl) and optionally "images" (.zip); answers with the per-row report
+    products=request.files.get("products")
+    if not products or not products.filename:
+        return jsonify(error="no products file uploaded"),400
+    archive=None
+    if request.files.get("images") and request.files["images"].filename:
+        try:
+            archive=zipfile.ZipFile(request.files["images"].stream)
+        except zipfile.BadZipFile:
+            return jsonify(error="images must be a zip archive"),400
+    try:
+        result=product_importer.run(read_rows(products.stream,products.filename),archive)
+    finally:
+        if archive:
+            archive.close()
+    catalog_changed()
+    return jsonify(result.as_dict())
+
+
+@shop.route("/admin_page/products/export.<fmt>")
+@login_required
+def export_products_download(fmt):
+    if fmt not in ("csv","jsonl"):
+        abort(404)
+    return Response(stream_with_context(export_lines(db,Product,Brand,Category,fmt)),
+                    mimetype="text/csv" if fmt=="csv" else "application/x-ndjson",
+                    headers={"Content-Disposition":f"attachment; filename=products.{fmt}"})
+
+
+@shop.route("/admin_page/metrics")
+def metrics():
+    # prometheus scrapers can't log in, so they send "Authorization: Bearer $METRICS_TOKEN" instead
+    token=os.environ.get("METRICS_TOKEN")
+    if not current_user.is_authenticated and not (token and request.headers.get("Authorization")=="Bearer "+token):
+        abort(401)
+    return request_metrics.prometheus()+pool_stats.prometheus(),200,{"Content-Type":"text/plain; version=0.0.4; charset=utf-8"}
+
+
 def require_login(func):
     @wraps(func)
     def fxn_decorator(*args,**kwargs):
         if not current_user.is_authenticated:
             flash("You must login first.")
-            return redirect(url_for("login"))
+            return redirect(url_for("shop.login"))
         return func(*args,**kwargs)
     return fxn_decorator
 
 
-@app.route("/home")
+@shop.route("/home")
 @require_login
+@conditional_page
+@replicas.reads
 def home():
     current_yr=date.today().year
-    page=request.args.get("page",1,type=int)
-    all_products=Product.query.filter(Product.stock>0).order_by(Product.id.desc()).paginate(page=page,per_page=8)
+    listing=listing_fragment(Product.stock>0,"home")
+
+    all_brands,all_categories=nav_lists()
+
+    return render_template("home.html",categories=all_categories,year=current_yr,logged_in=current_user.is_authenticated,listing=listing,brands=all_brands)
+
+
+def listing_query(condition):
+    # the unordered select the storefront listings page through (keyset_paginate adds order and limit)
+    return db.select(Product).where(condition)
+
+
+def listing_count_query(condition):
+    return db.select(db.func.count()).select_from(Product).where(condition)
+
 
-    data = db.session.execute(db.select(Brand))
-    all_brands = list(data.scalars())
+def product_listing(condition,count_key):
+    # newest first, paged by ?after=<id> / ?before=<id> cursors instead of OFFSET; the total is only for display so it is cached
+    total=listing_counts.get(count_key,lambda: db.session.execute(listing_count_query(condition)).scalar())
+    return keyset_paginate(db,listing_query(condition),Product.id,after=request.args.get("after",type=int),before=request.args.get("before",type=int),per_page=8,total=total)
 
-    all_categories=list(db.session.execute(db.select(Category)).scalars())
 
-    return render_template("home.html",categories=all_categories,year=current_yr,logged_in=current_user.is_authenticated,products=all_products,brands=all_brands)
+def listing_fragment(condition,count_key):
+    # the grid is the same for every user, so each page of it is queried and rendered once per catalog version
+    return page_fragments.get(request.full_path,lambda: Markup(render_template("product_grid.html",products=product_listing(condition,count_key))))
 
 
-@app.route("/product/<int:id>")
+@shop.route("/products/more")
 @login_required
+@replicas.reads
+def more_products():
+    # "load more" for the storefront listings: /products/more?after=<next_cursor>[&brand=<id>|&category=<id>]
+    if request.args.get("brand",type=int):
+        condition=Product.brand_id==request.args.get("brand",type=int)
+    elif request.args.get("category",type=int):
+        condition=Product.category_id==request.args.get("category",type=int)
+    else:
+        condition=Product.stock>0
+    per_page=min(request.args.get("per_page",8,type=int),48)
+    page=keyset_paginate(db,listing_query(condition),Product.id,after=request.args.get("after",type=int),per_page=per_page)
+    items=[{"id":product.id,"name":product.name,"price":str(product.price),"discount":product.discount,
+            "image":product_image(product.image_1,320),"url":url_for("shop.product_details",id=product.id)} for product in page.items]
+    return jsonify(items=items,next_cursor=page.next_cursor)
+
+
+@shop.route("/product/<int:id>")
+@login_required
+@conditional_page
+@replicas.reads
 def product_details(id):
     current_yr = date.today().year
 
     get_product=db.session.execute(db.select(Product).where(Product.id==id)).scalar()
+    if get_product is None:
+        abort(404)
 
-    data = db.session.execute(db.select(Brand))
-    all_brands = list(data.scalars())
-
-    all_categories = list(db.session.execute(db.select(Category)).scalars())
+    all_brands,all_categories=nav_lists()
 
     return render_template("product_details.html",product=get_product,year=current_yr,brands=all_brands,categories=all_categories,logged_in=current_user.is_authenticated)
 
 
-@app.route("/add-to-cart",methods=["GET","POST"])
+@shop.route("/add-to-cart",methods=["GET","POST"])
 def add2cart():
-    id=request.form.get("product_id")
-    quantity=request.form.get("quantity")
+    id=request.form.get("product_id",type=int)
+    quantity=request.form.get("quantity",type=int)
     color=request.form.get("color")
 
-    product=db.session.execute(db.select(Product).where(Product.id==id)).scalar()
-
-    item_dict={id:{"name":product.name,"price":product.price,"discount":product.discount,"quantity":quantity,"color":color,"image":product.image_1, "stock":product.stock,"colors":product.colors}}
-
     if request.method=="POST":
-        if "shopping_cart" in session:  # if the cart exists, do this
-            if id in session["shopping_cart"]:
-                for key, value in session["shopping_cart"].items():
-                    if key == id:
-                        value["quantity"] = int(quantity) + int(value["quantity"])
-                flash("The item is already in the cart.")
-                return redirect(url_for("cart_items"))
-            else:
-                session["shopping_cart"] = MergedItemsDict(session["shopping_cart"],item_dict)
-                flash(f"{item_dict[id]['name']} has been added to the cart.")
-                return redirect(url_for("home"))
-        else:
+        if quantity is None or quantity<1:
+            flash("Please choose a quantity of at least 1.")
+            return redirect(request.referrer or url_for("shop.home"))
+        product_name=db.session.execute(db.select(Product.name).where(Product.id==id)).scalar() if id is not None else None
+        if product_name is None:
+            # nothing is stored for a product that doesn't exist (or was deleted since the page was loaded)
+            abort(404)
+        if "cart_id" not in session:
             # cart has been established for the 1st time and the first item will be added in the cart.
-            session["shopping_cart"]=item_dict
-            flash(f"{item_dict[id]['name']} has been added to the cart.")
-            return redirect(url_for("home"))
+            session["cart_id"]=secrets.token_hex(16)
+
+        if not cart_store.add(session["cart_id"],id,quantity,color):
+            flash("The item is already in the cart.")
+            return redirect(url_for("shop.cart_items"))
+        update_cart_count()
+        flash(f"{product_name} has been added to the cart.")
+        return redirect(url_for("shop.home"))
 
     return False
 
 
-@app.route("/cart_items")
+@shop.route("/cart_items")
 @login_required
 def cart_items():
     current_yr=date.today().year
-    data = db.session.execute(db.select(Brand))
-    all_brands = list(data.scalars())
+    all_brands,all_categories=nav_lists()
 
-    all_categories = list(db.session.execute(db.select(Category)).scalars())
-
-    if "shopping_cart" not in session or len(session["shopping_cart"])==0:
+    shopping_cart=load_cart()
+    if len(shopping_cart)==0:
         flash("Your cart is empty.")
-        return redirect(url_for("home"))
-    else:
-        subtotal=0
-        for key,value in session["shopping_cart"].items():
-            rate = int(value["discount"]) / 100
-            discount = (float(value["price"]) * int(value["quantity"])) * rate
-            subtotal += (float(value["price"]) * int(value["quantity"])) - discount
-            tax = "%.2f" % (0.05 * subtotal) # .05 means 5% tax
-            total = "%.2f" % (1.05 * subtotal)
-    return render_template("cart.html",logged_in=current_user.is_authenticated,brands=all_brands,categories=all_categories,year=current_yr,total=float(total),amount=subtotal,tax=float(tax))
+        return redirect(url_for("shop.home"))
+    totals=price_items(shopping_cart)
+    return render_template("cart.html",cart=shopping_cart,logged_in=current_user.is_authenticated,brands=all_brands,categories=all_categories,year=current_yr,total=totals.total,amount=totals.amount,tax=totals.tax,line_totals=totals.lines)
 
 
-@app.route("/update_cart/item-<int:id>",methods=["GET","POST"])
+@shop.route("/update_cart/item-<int:id>",methods=["GET","POST"])
 def update_cart(id):
     if request.method=="POST":
-        quantity=request.form.get("quantity")
+        quantity=request.form.get("quantity",type=int)
         color=request.form.get("color")
-
-        for key,value in session["shopping_cart"].items():
-            if int(key)==id:
-                value["quantity"]=quantity
-                value["color"]=color
-                flash(f"Your item {value['name']} has been updated.")
-                return redirect(url_for("cart_items"))
+        if quantity is None or quantity<1:
+            flash("Please choose a quantity of at least 1.")
+            return redirect(url_for("shop.cart_items"))
+
+        if "cart_id" in session and cart_store.update(session["cart_id"],id,quantity,color):
+            product_name=db.session.execute(db.select(Product.name).where(Product.id==id)).scalar()
+            flash(f"Your item {product_name} has been updated.")
+            return redirect(url_for("shop.cart_items"))
     return False
 
 
-@app.route("/delete_item/item-<int:id>")
+@shop.route("/delete_item/item-<int:id>")
 @login_required
 def delete_item(id):
-    session.modified=True # required in deleting dictionary data in session
-    for key,value in session["shopping_cart"].items():
-        if int(key)==id:
-            session["shopping_cart"].pop(key,None)
-            return redirect(url_for("cart_items"))
-    return False
+    if "cart_id" in session:
+        cart_store.remove(session["cart_id"],id)
+        update_cart_count()
+    return redirect(url_for("shop.cart_items"))
 
 
-@app.route("/delete_cart")
+@shop.route("/delete_cart")
 def delete_cart():
-    session.modified=True
-    session.pop("shopping_cart",None)
+    if "cart_id" in session:
+        cart_store.clear(session.pop("cart_id"))
+    session.pop("cart_count",None)
     flash("Your cart is empty.")
-    return redirect(url_for("home"))
+    return redirect(url_for("shop.home"))
 
 
-@app.route("/search_results",methods=["GET","POST"])
+@shop.route("/search_results",methods=["GET","POST"])
+@replicas.reads
 def search_results():
     current_yr = date.today().year
-    data = db.session.execute(db.select(Brand))
-    all_brands = list(data.scalars())
+    all_brands,all_categories=nav_lists()
 
-    all_categories = list(db.session.execute(db.select(Category)).scalars())
-
-    if request.method=="POST":
-        keyword=request.form.get("keyword")
-        results=db.session.execute(db.select(Product).where((Product.name.like('%'+str(keyword)+'%'))|(Product.description.like('%'+str(keyword)+'%'))))
-        all_products=list(results.scalars())
-        return render_template("results.html",brands=all_brands,categories=all_categories,year=current_yr,products=all_products,keyword=keyword,logged_in=current_user.is_authenticated)
-    return False
+    keyword=request.form.get("keyword") if request.method=="POST" else request.args.get("keyword")
+    page=request.args.get("page",1,type=int)
+    all_products=product_search.search(keyword,page=page,per_page=8)
+    return render_template("results.html",brands=all_brands,categories=all_categories,year=current_yr,products=all_products,keyword=keyword,logged_in=current_user.is_authenticated)
 
 
-@app.route("/get_brand/<int:id>")
+@shop.route("/get_brand/<int:id>")
 @login_required
+@conditional_page
+@replicas.reads
 def get_brand(id):
     current_yr = date.today().year
-    page=request.args.get("page",1,type=int)
-
-    all_products=Product.query.filter(Product.brand_id==id).paginate(page=page,per_page=8)
+    listing=listing_fragment(Product.brand_id==id,("brand",id))
 
-    data = db.session.execute(db.select(Brand))
-    all_brands = list(data.scalars())
+    all_brands,all_categories=nav_lists()
 
-    all_categories = list(db.session.execute(db.select(Category)).scalars())
+    return render_template("home.html",categories=all_categories,year=current_yr,logged_in=current_user.is_authenticated,listing=listing,brands=all_brands)
 
-    return render_template("home.html",categories=all_categories,year=current_yr,logged_in=current_user.is_authenticated,products=all_products,brands=all_brands)
 
-
-@app.route("/get_category/<int:id>")
+@shop.route("/get_category/<int:id>")
 @login_required
+@conditional_page
+@replicas.reads
 def get_category(id):
     current_yr = date.today().year
-    page=request.args.get("page",1,type=int)
-
-    all_products=Product.query.filter(Product.category_id==id).paginate(page=page,per_page=8)
+    listing=listing_fragment(Product.category_id==id,("category",id))
 
-    data = db.session.execute(db.select(Brand))
-    all_brands = list(data.scalars())
+    all_brands,all_categories=nav_lists()
 
-    all_categories = list(db.session.execute(db.select(Category)).scalars())
+    return render_template("home.html",brands=all_brands,categories=all_categories,listing=listing,year=current_yr,logged_in=current_user.is_authenticated)
 
-    return render_template("home.html",brands=all_brands,categories=all_categories,products=all_products,year=current_yr,logged_in=current_user.is_authenticated)
 
-
-@app.route("/brands")
+@shop.route("/brands")
 @login_required
+@conditional_page
+@replicas.reads
 def display_brands():
     current_yr = date.today().year
     result = db.session.execute(db.select(Brand))
@@ -338,8 +832,10 @@ def display_brands():
     return render_template("brands.html",logged_in=current_user.is_authenticated,year=current_yr,brands=all_brands)
 
 
-@app.route("/categories")
+@shop.route("/categories")
 @login_required
+@conditional_page
+@replicas.reads
 def display_categories():
     current_yr = date.today().year
     result = db.session.execute(db.select(Category))
@@ -347,10 +843,43 @@ def display_categories():
     return render_template("categories.html",logged_in=current_user.is_authenticated,year=current_yr,categories=all_categories)
 
 
-@app.route("/register",methods=["GET","POST"])
+def api_response(payload,status=200):
+    return Response(catalog_api.dumps(payload),status,mimetype="application/json")
+
+
+@shop.route("/api/v1/<any(products,brands,categories):resource>")
+@api_conditional
+@replicas.reads
+def api_list(resource):
+    # ?fields=id,name,price  ?ids=1,2,3  ?after=<next_cursor>&per_page=50  (products also ?brand= ?category= ?in_stock=1)
+    try:
+        return api_response(catalog_api.listing(resource,request.args))
+    except ApiError as error:
+        return api_response({"error":str(error)},400)
+
+
+@shop.route("/api/v1/<any(products,brands,categories):resource>/<int:id>")
+@api_conditional
+@replicas.reads
+def api_detail(resource,id):
+    try:
+        item=catalog_api.detail(resource,id,request.args)
+    except ApiError as error:
+        return api_response({"error":str(error)},400)
+    if item is None:
+        return api_response({"error":"not found"},404)
+    return api_response(item)
+
+
+@shop.route("/register",methods=["GET","POST"])
 def register():
     current_yr = date.today().year
     if request.method=="POST":
+        try:
+            login_throttle.check(request.remote_addr)
+        except Throttled as error:
+            flash("Too many attempts. Please try again in a few minutes.")
+            return render_template("register.html",year=current_yr),429,{"Retry-After":str(error.retry_after)}
         fname=request.form.get("fname")
         lname = request.form.get("lname")
         username = request.form.get("username")
@@ -367,30 +896,32 @@ def register():
 
         if user:
             flash("The email address already exist. Please login.")
-            return redirect(url_for("login"))
+            return redirect(url_for("shop.login"))
         else:
             registered = db.session.execute(db.select(User).where(User.username == username)).scalar()
 
             if registered:
                 flash("The username is already taken.")
-                return redirect(url_for("register"))
+                return redirect(url_for("shop.register"))
             else:
                 if password != pword:
                     flash("The password must match with the retyped password.")
-                    return redirect(url_for("register"))
+                    return redirect(url_for("shop.register"))
                 else:
                     filename = secure_filename(user_photo.filename)
 
-                    if filename.endswith(".jpg") or filename.endswith(".jpeg") or filename.endswith(".gif") or filename.endswith(".png"):
-                        img_dir = "static/images/profile_pic"
-                        file_name = secrets.token_hex(10) + filename.split('.')[1]
-                        file_path = os.path.join(img_dir, file_name)
-                        user_photo.save(file_path)
-                    else:
+                    if not profile_images.allowed(filename):
                         flash("Wrong file. Please upload an image.")
-                        return redirect(url_for("register"))
-
-                    hashed_and_salted_password = generate_password_hash(password, method="scrypt", salt_length=8)
+                        return redirect(url_for("shop.register"))
+
+                    # hashed before the photo is stored, so a busy answer leaves no orphaned file behind
+                    try:
+                        hashed_and_salted_password = password_hasher.hash(password)
+                    except HashingBusy:
+                        flash("We are very busy right now. Please try again in a moment.")
+                        return render_template("register.html",year=current_yr),503,{"Retry-After":"5"}
+                    # User.profile_pic is unique, so two users never share a file
+                    file_name = profile_images.store(user_photo,filename,unique=True)
                     new_user = User(first_name=fname, last_name=lname, username=username, email=email,
                                     password=hashed_and_salted_password,
                                     address=address, state=state, country=country, zipcode=zipcode,
@@ -398,120 +929,136 @@ def register():
                     db.session.add(new_user)
                     db.session.commit()
                     flash(f"Congrats, {fname.title()}! You are now registered.")
-                    return redirect(url_for('login'))
+                    return redirect(url_for('shop.login'))
     return render_template("register.html",year=current_yr)
 
 
-@app.route("/logout")
+@shop.route("/logout")
 def logout():
     logout_user()
     flash("You have logged out.")
-    return redirect(url_for("login"))
+    return redirect(url_for("shop.login"))
 
 
-def update_shoppingcart():
-    for key,value in session["shopping_cart"].items():
-        del value["image"]
-        del value["colors"]
+def release_product_image(filename):
+    # products that uploaded the same file share it, so only delete it once nothing points at it
+    in_use=db.session.execute(db.select(db.func.count()).select_from(Product).where((Product.image_1==filename)|(Product.image_2==filename)|(Product.image_3==filename))).scalar()
+    if not in_use:
+        product_images.delete(filename)
 
 
-@app.route("/checkout")
-@login_required
-def make_order():
-    update_shoppingcart()
-    invoice=secrets.token_hex(5)
-    new_order=Order(invoice=invoice,customer_id=current_user.id,items=session["shopping_cart"])
-    db.session.add(new_order)
-
-    for key, value in session["shopping_cart"].items():
-        product = db.session.execute(db.select(Product).where(Product.name == value["name"])).scalar()
-        product.stock = product.stock - int(value["quantity"])
+def order_line_rows(order):
+    # orders not moved yet by "flask backfill-order-lines" still keep their lines in the json column
+    if order.lines:
+        return order.lines
+    return [OrderLine(**values) for values in order_lines.lines_from_items(order.items or {})]
 
-    db.session.commit()
-    session.modified=True
-    session.pop("shopping_cart",None)
-    return redirect(url_for("order_details",invoice=invoice))
 
+@shop.route("/checkout")
+@login_required
+def make_order():
+    shopping_cart=load_cart()
+    if len(shopping_cart)==0:
+        flash("Your cart is empty.")
+        return redirect(url_for("shop.home"))
 
-@app.route("/order/invoice:<invoice>")
+    invoice=secrets.token_hex(5)
+    totals=price_items(shopping_cart)
+    try:
+        checkout.place_order(invoice,current_user.id,shopping_cart,totals)
+    except InsufficientStock as error:
+        flash("Sorry, there is not enough stock left for: "+(", ".join(f"{name} ({stock} left)" for name,stock in error.products) or "some items")+".")
+        return redirect(url_for("shop.cart_items"))
+    except InvalidQuantity as error:
+        flash("Please choose a quantity of at least 1 for: "+", ".join(error.products)+".")
+        return redirect(url_for("shop.cart_items"))
+
+    cart_store.clear(session.pop("cart_id"))
+    session.pop("cart_count",None)
+    return redirect(url_for("shop.order_details",invoice=invoice))
+
+
+@shop.route("/order/invoice:<invoice>")
 @login_required
 def order_details(invoice):
     current_yr=date.today().year
-    customer=db.session.execute(db.select(User).where(User.id==current_user.id)).scalar()
     customer_order=db.session.execute(db.select(Order).where((Order.customer_id==current_user.id) & (Order.invoice==invoice))).scalar()
+    if customer_order is None:
+        abort(404)
+    lines=order_line_rows(customer_order)
+    totals=order_totals(customer_order,lines)
 
-    subtotal=0
-    for key,value in customer_order.items.items():
-        rate=int(value["discount"])/100
-        discount=(float(value["price"]) * int(value["quantity"])) * rate
-        subtotal+=(float(value["price"]) * int(value["quantity"])) - discount
-        tax="%.2f" % (.05 * subtotal)
-        total="%.2f" % (1.05 * subtotal)
+    return render_template("order_details.html",year=current_yr,logged_in=current_user.is_authenticated,invoice=invoice,customer=current_user,order=customer_order,amount=totals.amount,tax=totals.tax,total=str(totals.total),lines=lines)
 
-    return render_template("order_details.html",year=current_yr,logged_in=current_user.is_authenticated,invoice=invoice,customer=customer,order=customer_order,amount=subtotal,tax=float(tax),total=total)
 
-
-@app.route("/invoice_pdf/invoice:<invoice>",methods=["POST"])
+@shop.route("/invoice_pdf/invoice:<invoice>",methods=["GET","POST"])
 @login_required
 def order_details_as_pdf(invoice):
-    if request.method=="POST":
-        customer = db.session.execute(db.select(User).where(User.id == current_user.id)).scalar()
-        customer_order = db.session.execute(db.select(Order).where((Order.customer_id == current_user.id) & (Order.invoice == invoice))).scalar()
-
-        subtotal = 0
-        for key, value in customer_order.items.items():
-            rate = int(value["discount"]) / 100
-            discount = (float(value["price"]) * int(value["quantity"])) * rate
-            subtotal += (float(value["price"]) * int(value["quantity"])) - discount
-            tax = "%.2f" % (.05 * subtotal)
-            total = "%.2f" % (1.05 * subtotal)
-
-        html_page=render_template("pdf.html",invoice=invoice,customer=customer,order=customer_order,amount=subtotal,tax=float(tax),total=float(total))
-        # view as pdf
-        config=pdfkit.configuration(wkhtmltopdf=r"C:\Program Files\wkhtmltopdf\bin\wkhtmltopdf.exe")
-        pdf=pdfkit.from_string(html_page,configuration=config,options={"enable-local-file-access":""})
-        response=make_response(pdf)
-        response.headers["content-Type"]="application/pdf"
-        response.headers["content-Disposition"]="inline; filename="+invoice+".pdf"
-        # view as pdf
-        return response
-    return False
-
-
-@app.route("/purchase",methods=["GET","POST"])
+    customer_order = db.session.execute(db.select(Order).where((Order.customer_id == current_user.id) & (Order.invoice == invoice))).scalar()
+    if customer_order is None:
+        abort(404)
+
+    # the pdf shows the order status, so a paid order gets a fresh file
+    key=f"{invoice}-{customer_order.status}"
+    pdf_path=invoice_renderer.cached(key)
+    if pdf_path is None:
+        lines=order_line_rows(customer_order)
+        totals=order_totals(customer_order,lines)
+        html_page=render_template("pdf.html",invoice=invoice,customer=current_user,order=customer_order,amount=totals.amount,tax=totals.tax,total=totals.total,lines=lines)
+        job=invoice_renderer.submit(key,html_page)
+        try:
+            pdf_path=job.result(timeout=PDF_WAIT_SECONDS)
+        except TimeoutError:
+            # still rendering in the background; the browser retries with a GET and gets the cached file
+            response=make_response("Your invoice is being prepared...",202)
+            response.headers["Refresh"]="2"
+            return response
+        except Exception:
+            current_app.logger.exception("invoice %s could not be rendered",invoice)
+            flash("Sorry, the invoice could not be generated. Please try again.")
+            return redirect(url_for("shop.order_details",invoice=invoice))
+
+    # view as pdf
+    return send_file(pdf_path,mimetype="application/pdf",download_name=invoice+".pdf")
+
+
+@shop.route("/purchase",methods=["GET","POST"])
+@login_required
 def get_payment():
     if request.method=="POST":
         invoice=request.form.get("invoice")
-        amount=request.form.get("amount")
-
-        customer=db.session.execute(db.select(User).where(User.id==current_user.id)).scalar()
-        customer_order=db.session.execute(db.select(Order).where((Order.customer_id==current_user.id) & (Order.invoice==invoice))).scalar()
-
-        customer_order.status = "paid"
-        db.session.commit()
-
-        customer = stripe.Customer.create(
-            email=customer.email,
-            source=request.form['stripeToken'],
-        )
-
-        charge = stripe.Charge.create(
-            customer=customer.id,
-            description='Custom t-shirt',
-            amount=amount,
-            currency='usd',
-        )
-        return redirect(url_for("thanx4shopping"))
+        # the amount charged comes from the stored order total, not from the form
+        status=db.session.execute(db.select(Order.status).where((Order.customer_id==current_user.id) & (Order.invoice==invoice))).scalar()
+        if status is None:
+            abort(404)
+        if status=="paid":
+            return redirect(url_for("shop.thanx4shopping"))
+
+        job=payments.submit(invoice,current_user.email,request.form.get("stripeToken"))
+        try:
+            job.result(timeout=PAYMENT_WAIT_SECONDS)
+        except TimeoutError:
+            # the charge carries on in the background; the order shows as paid once it is confirmed
+            flash("Your payment is being processed. The order will show as paid once your card has been charged.")
+            return redirect(url_for("shop.order_details",invoice=invoice))
+        except PaymentFailed as error:
+            flash(f"Sorry, your payment did not go through: {error}")
+            return redirect(url_for("shop.order_details",invoice=invoice))
+        except Exception:
+            current_app.logger.exception("payment for order %s failed",invoice)
+            flash("Sorry, the payment service is not available right now. Please try again.")
+            return redirect(url_for("shop.order_details",invoice=invoice))
+        return redirect(url_for("shop.thanx4shopping"))
     return False
 
 
-@app.route("/thanx")
+@shop.route("/thanx")
 def thanx4shopping():
     current_yr=date.today().year
     return render_template("thanks.html",year=current_yr)
 
 
-@app.route("/add_brand",methods=["GET","POST"])
+@shop.route("/add_brand",methods=["GET","POST"])
 def add_brand():
     current_yr = date.today().year
     form=BrandForm()
@@ -525,12 +1072,13 @@ def add_brand():
             new_brand = Brand(name=name.title())
             db.session.add(new_brand)
             db.session.commit()
+            catalog_changed()
             flash(f"The brand {name.title()} has been added to the database.")
-            return redirect(url_for("add_brand"))
+            return redirect(url_for("shop.add_brand"))
     return render_template("add_brand.html",form=form,year=current_yr,logged_in=current_user.is_authenticated)
 
 
-@app.route("/edit_brand/<int:brand_id>",methods=["GET","POST"])
+@shop.route("/edit_brand/<int:brand_id>",methods=["GET","POST"])
 def edit_brand(brand_id):
     current_yr=date.today().year
     requested_brand=db.session.execute(db.select(Brand).where(Brand.id==brand_id)).scalar()
@@ -539,24 +1087,26 @@ def edit_brand(brand_id):
     if update_form.validate_on_submit():
         requested_brand.name=update_form.brand.data
         db.session.commit()
+        catalog_changed()
         flash("The brand name has been successfully updated.")
-        return redirect(url_for('display_brands'))
+        return redirect(url_for('shop.display_brands'))
 
     return render_template("edit_brand.html",year=current_yr,form=update_form,logged_in=current_user.is_authenticated)
 
 
-@app.route("/delete_brand/<int:id>",methods=["POST"])
+@shop.route("/delete_brand/<int:id>",methods=["POST"])
 def delete_brand(id):
     if request.method=="POST":
         brand=db.session.execute(db.select(Brand).where(Brand.id==id)).scalar()
         db.session.delete(brand)
         db.session.commit()
+        catalog_changed()
         flash("The brand has been successfully deleted.")
-        return redirect(url_for('display_brands'))
+        return redirect(url_for('shop.display_brands'))
     return False
 
 
-@app.route("/add_category",methods=["GET","POST"])
+@shop.route("/add_category",methods=["GET","POST"])
 def add_category():
     current_yr = date.today().year
     form = CategoryForm()
@@ -570,12 +1120,13 @@ def add_category():
             new_category = Category(name=name)
             db.session.add(new_category)
             db.session.commit()
+            catalog_changed()
             flash(f"The {name.lower()} category has been added to the database.")
-            return redirect(url_for("add_category"))
+            return redirect(url_for("shop.add_category"))
     return render_template("add_category.html",form=form,year=current_yr,logged_in=current_user.is_authenticated)
 
 
-@app.route("/edit_category/<int:category_id>",methods=["GET","POST"])
+@shop.route("/edit_category/<int:category_id>",methods=["GET","POST"])
 def edit_category(category_id):
     current_yr=date.today().year
     requested_category=db.session.execute(db.select(Category).where(Category.id==category_id)).scalar()
@@ -584,22 +1135,24 @@ def edit_category(category_id):
     if update_form.validate_on_submit():
         requested_category.name=update_form.category.data
         db.session.commit()
+        catalog_changed()
         flash("The category name has been successfully updated.")
-        return redirect(url_for('display_categories'))
+        return redirect(url_for('shop.display_categories'))
 
     return render_template("edit_category.html",year=current_yr,form=update_form,logged_in=current_user.is_authenticated)
 
 
-@app.route("/delete_category/<int:id>",methods=["POST"])
+@shop.route("/delete_category/<int:id>",methods=["POST"])
 def delete_category(id):
     if request.method=="POST":
         db.session.delete(db.session.execute(db.select(Category).where(Category.id==id)).scalar())
         db.session.commit()
+        catalog_changed()
         flash("The category has been deleted.")
-        return redirect(url_for('display_categories'))
+        return redirect(url_for('shop.display_categories'))
 
 
-@app.route("/edit_product/<int:product_id>",methods=["GET","POST"])
+@shop.route("/edit_product/<int:product_id>",methods=["GET","POST"])
 def edit_product(product_id):
     current_yr = date.today().year
 
@@ -611,9 +1164,8 @@ def edit_product(product_id):
 
     requested_product=db.session.execute(db.select(Product).where(Product.id==product_id)).scalar()
 
-    img_dir="static/images/products"
-
     if request.method=="POST":
+        replaced=[]
         requested_product.name=request.form.get("name")
         requested_product.price = request.form.get("price")
         requested_product.discount=request.form.get("discount")
@@ -630,12 +1182,9 @@ def edit_product(product_id):
         if img1_file:
             img1 = secure_filename(img1_file.filename)
 
-            if img1.endswith(".jpg") or img1.endswith(".gif") or img1.endswith(".png") or img1.endswith(".jpeg"):
-                os.unlink(os.path.join(img_dir, requested_product.image_1))
-                img_1=secrets.token_hex(10) + '.' + img1.split('.')[1]
-                img1_filepath = os.path.join(img_dir, img_1)
-                img1_file.save(img1_filepath)
-                requested_product.image_1 = img_1
+            if product_images.allowed(img1):
+                replaced.append(requested_product.image_1)
+                requested_product.image_1 = product_images.store(img1_file,img1)
             else:
                 flash("Wrong file. Please upload an image.")
                 return render_template("edit_product.html", year=current_yr, product=requested_product,
@@ -644,12 +1193,9 @@ def edit_product(product_id):
         if img2_file:
             img2 = secure_filename(img2_file.filename)
 
-            if img2.endswith(".jpg") or img2.endswith(".gif") or img2.endswith(".png") or img2.endswith(".jpeg"):
-                os.unlink(os.path.join(img_dir, requested_product.image_2))
-                img_2 = secrets.token_hex(10) + '.' + img2.split('.')[1]
-                img2_filepath = os.path.join(img_dir, img_2)
-                img2_file.save(img2_filepath)
-                requested_product.image_2 = img_2
+            if product_images.allowed(img2):
+                replaced.append(requested_product.image_2)
+                requested_product.image_2 = product_images.store(img2_file,img2)
             else:
                 flash("Wrong file. Please upload an image.")
                 return render_template("edit_product.html", year=current_yr, product=requested_product,
@@ -658,25 +1204,26 @@ def edit_product(product_id):
         if img3_file:
             img3 = secure_filename(img3_file.filename)
 
-            if img3.endswith(".jpg") or img3.endswith(".gif") or img3.endswith(".png") or img3.endswith(".jpeg"):
-                os.unlink(os.path.join(img_dir, requested_product.image_3))
-                img_3 = secrets.token_hex(10) + '.' + img3.split('.')[1]
-                img3_filepath = os.path.join(img_dir, img_3)
-                img3_file.save(img3_filepath)
-                requested_product.image_3 = img_3
+            if product_images.allowed(img3):
+                replaced.append(requested_product.image_3)
+                requested_product.image_3 = product_images.store(img3_file,img3)
             else:
                 flash("Wrong file. Please upload an image.")
                 return render_template("edit_product.html", year=current_yr, product=requested_product,
                                            brands=all_brands, categories=all_categories, is_error=True,logged_in=current_user.is_authenticated)
 
+        product_search.index_product(requested_product)
         db.session.commit()
+        catalog_changed()
+        for image in replaced:
+            release_product_image(image)
         flash("The product has been successfully updated.")
-        return redirect(url_for('admin'))
+        return redirect(url_for('shop.admin'))
 
     return render_template("edit_product.html",year=current_yr,product=requested_product,brands=all_brands,categories=all_categories,logged_in=current_user.is_authenticated)
 
 
-@app.route("/add_product",methods=["GET","POST"])
+@shop.route("/add_product",methods=["GET","POST"])
 def add_product():
     current_yr = date.today().year
 
@@ -686,8 +1233,6 @@ def add_product():
     data = db.session.execute(db.select(Category).order_by(Category.name))
     all_categories = list(data.scalars())
 
-    img_dir="static/images/products"
-
     if request.method=="POST":
         name=request.form.get("name")
         price = request.form.get("price")
@@ -705,54 +1250,57 @@ def add_product():
         img2 = secure_filename(file2.filename)
         img3 = secure_filename(file3.filename)
 
-        if img1.endswith(".jpg") or img1.endswith(".gif") or img1.endswith(".jpeg") or img1.endswith(".png"):
-            img_1 = secrets.token_hex(10) + '.' + img1.split('.')[1]
-        else:
+        if not product_images.allowed(img1):
             flash("Wrong file. Pls upload an image.")
             return render_template("add_product.html", year=current_yr, brands=all_brands, categories=all_categories,
                                    is_error=True, logged_in=current_user.is_authenticated)
 
-        if img2.endswith(".jpg") or img2.endswith(".gif") or img2.endswith(".jpeg") or img2.endswith(".png"):
-            img_2 = secrets.token_hex(10) + '.' + img2.split('.')[1]
-        else:
+        if not product_images.allowed(img2):
             flash("Wrong file. Pls upload an image.")
             return render_template("add_product.html", year=current_yr, brands=all_brands, categories=all_categories,
                                    is_error=True, logged_in=current_user.is_authenticated)
 
-        if img3.endswith(".jpg") or img3.endswith(".gif") or img3.endswith(".jpeg") or img3.endswith(".png"):
-            img_3 = secrets.token_hex(10) + '.' + img3.split('.')[1]
-        else:
+        if not product_images.allowed(img3):
             flash("Wrong file. Pls upload an image.")
             return render_template("add_product.html", year=current_yr, brands=all_brands, categories=all_categories,
                                    is_error=True, logged_in=current_user.is_authenticated)
 
-        file1.save(os.path.join(img_dir, img_1))
-        file2.save(os.path.join(img_dir, img_2))
-        file3.save(os.path.join(img_dir, img_3))
+        # validated all three before storing any, so a bad third file leaves nothing behind
+        img_1=product_images.store(file1,img1)
+        img_2=product_images.store(file2,img2)
+        img_3=product_images.store(file3,img3)
 
         new_product=Product(name=name,price=price,discount=discount,stock=stock,description=desc,
                 colors=colors,brand_id=brand_id,category_id=category_id,image_1=img_1,image_2=img_2,image_3=img_3)
         db.session.add(new_product)
+        db.session.flush()
+        product_search.index_product(new_product)
         db.session.commit()
+        catalog_changed()
         flash("The product has been added to the database.")
-        return redirect(url_for("admin"))
+        return redirect(url_for("shop.admin"))
 
     return render_template("add_product.html",year=current_yr,brands=all_brands,categories=all_categories,logged_in=current_user.is_authenticated)
 
 
-@app.route("/delete_product/<int:id>",methods=["POST"])
+@shop.route("/delete_product/<int:id>",methods=["POST"])
 def delete_product(id):
-    img_dir = "static/images/products"
     if request.method=="POST":
         product=db.session.execute(db.select(Product).where(Product.id==id)).scalar()
-        os.unlink(os.path.join(img_dir,product.image_1))
-        os.unlink(os.path.join(img_dir, product.image_2))
-        os.unlink(os.path.join(img_dir, product.image_3))
+        images={product.image_1,product.image_2,product.image_3}
+        product_search.remove_product(product.id)
         db.session.delete(product)
         db.session.commit()
-        return redirect(url_for('admin'))
+        catalog_changed()
+        for image in images:
+            release_product_image(image)
+        return redirect(url_for('shop.admin'))
     return False
 
 
 if __name__=="__main__":
+    # development server; also brings the schema up to date, which production leaves to "flask migrate"
+    app=create_app()
+    with app.app_context():
+        migrate()
     app.run(debug=False)
\ No newline at end of file
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNTS = (1, 2, 3, 5, 10, 20, 50, 100)
+BYTES = (1000, 5000, 10000, 50000, 100000, 500000, 1000000)
+
+# name, help, buckets
+SERIES = (
+    ("shop_request_duration_seconds", "Wall time spent handling the request.", SECONDS),
+    ("shop_request_db_seconds", "Time spent executing SQL statements.", SECONDS),
+    ("shop_request_render_seconds", "Time spent in render_template.", SECONDS),
+    ("shop_request_queries", "SQL statements executed.", COUNTS),
+    ("shop_response_bytes", "Response body size.", BYTES),
+)
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RequestMetrics:
+    # Per-request SQL count, DB time, template time and response size, aggregated per endpoint.
+    # Numbers are per worker process; each gunicorn worker reports its own.
+
+    def __init__(self, app=None, query_budget=20):
+        self.query_budget = query_budget
+        self._histograms = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+        # on the Engine class so every engine the app creates is covered; only once, however many apps
+        # this object is set up for, or every statement would be counted once per app
+        if not event.contains(Engine, "before_cursor_execute", self._query_started):
+            event.listen(Engine, "before_cursor_execute", self._query_started)
+            event.listen(Engine, "after_cursor_execute", self._query_finished)
+
+    def _start(self):
+        g.metrics = {"start": time.perf_counter(), "queries": 0, "db": 0.0, "render": 0.0, "render_start": []}
+
+    def _query_started(self, conn, cursor, statement, parameters, context, executemany):
+        # kept on the statement's execution context, not the connection: a statement that raises never
+        # reaches after_cursor_execute, and its start time goes away with the context
+        context.metrics_start = time.perf_counter()
+
+    def _query_finished(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.metrics_start
+        if has_request_context() and "metrics" in g:
+            g.metrics["queries"] += 1
+            g.metrics["db"] += elapsed
+
+    def _render_started(self, sender, template, context, **extra):
+        if "metrics" in g:
+            g.metrics["render_start"].append(time.perf_counter())
+
+    def _render_finished(self, sender, template, context, **extra):
+        if "metrics" in g and g.metrics["render_start"]:
+            g.metrics["render"] += time.perf_counter() - g.metrics["render_start"].pop()
+
+    def _finish(self, response):
+        data = g.pop("metrics", None)
+        if data is None:
+            return response
+        endpoint = request.endpoint or "unmatched"
+        size = response.content_length if response.content_length is not None else response.calculate_content_length() or 0
+        values = (time.perf_counter() - data["start"], data["db"], data["render"], data["queries"], size)
+        with self._lock:
+            for (name, _, buckets), value in zip(SERIES, values):
+                histogram = self._histograms.get((name, endpoint))
+                if histogram is None:
+                    histogram = self._histograms[(name, endpoint)] = Histogram(buckets)
+                histogram.observe(value)
+
+        if data["queries"] > self.query_budget:
+            logger.warning("%s ran %d SQL statements (budget %d) in %.1f ms of DB time",
+                           endpoint, data["queries"], self.query_budget, data["db"] * 1000)
+        return response
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            for name, help_text, _ in SERIES:
+                lines.append("# HELP %s %s" % (name, help_text))
+                lines.append("# TYPE %s histogram" % name)
+                for (series, endpoint), histogram in sorted(self._histograms.items()):
+                    if series != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (name, endpoint, bound, cumulative))
+                    lines.append('%s_sum{endpoint="%s"} %s' % (name, endpoint, repr(float(histogram.sum))))
+                    lines.append('%s_count{endpoint="%s"} %d' % (name, endpoint, histogram.count))
+        return "\n".join(lines) + "\n"
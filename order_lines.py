@@ -0,0 +1,69 @@
+from decimal import Decimal
+
+from pricing import price_items, to_cents, TAX_RATE
+
+
+def lines_from_items(items, totals=None):
+    # items in the cart / legacy Order.items shape -> OrderLine column values.
+    # A stored line_total is what the customer was charged, so it wins over re-pricing.
+    totals = totals or price_items(items)
+    return [{"product_id": int(key), "name": value["name"], "quantity": int(value["quantity"]),
+             "unit_price": Decimal(str(value["price"])), "discount": int(value["discount"] or 0),
+             "color": value.get("color"), "line_total": Decimal(value.get("line_total") or totals.lines[key])}
+            for key, value in items.items()]
+
+
+def totals_from_lines(lines):
+    # (amount, tax, total) of an order placed before totals were stored, from its lines_from_items() values;
+    # the same sums pricing.order_totals shows on the order page
+    amount = sum((line["line_total"] for line in lines), Decimal(0))
+    tax = to_cents(amount * TAX_RATE)
+    return amount, tax, amount + tax
+
+
+def backfill(db, Order, OrderLine, batch_size=500):
+    # moves the json carts of orders that have no OrderLine rows yet into order_lines, in id order and
+    # batch_size orders per transaction, so it can be stopped and re-run. Orders placed before totals
+    # were stored get them filled in from the same lines.
+    moved = 0
+    last_id = 0
+    has_lines = db.select(OrderLine.order_id).where(OrderLine.order_id == Order.id).exists()
+    while True:
+        rows = db.session.execute(
+            db.select(Order.id, Order.items, Order.total)
+            .where(Order.id > last_id, ~has_lines)
+            .order_by(Order.id).limit(batch_size)).all()
+        if not rows:
+            break
+        values = []
+        for order_id, items, total in rows:
+            lines = lines_from_items(items or {})
+            values.extend(dict(line, order_id=order_id) for line in lines)
+            if total is None:
+                amount, tax, total = totals_from_lines(lines)
+                db.session.execute(db.update(Order).where(Order.id == order_id)
+                                   .values(amount=amount, tax=tax, total=total))
+        if values:
+            db.session.execute(db.insert(OrderLine), values)
+        db.session.commit()
+        moved += len(rows)
+        last_id = rows[-1].id
+    return moved
+
+
+def sales_by_product(db, Order, OrderLine, status=None, since=None, limit=None):
+    # units sold and revenue per product, best sellers first; summed by the database
+    units = db.func.sum(OrderLine.quantity).label("units")
+    revenue = db.func.sum(OrderLine.line_total).label("revenue")
+    statement = (db.select(OrderLine.product_id, db.func.max(OrderLine.name).label("name"), units, revenue,
+                           db.func.count(db.distinct(OrderLine.order_id)).label("orders"))
+                 .group_by(OrderLine.product_id).order_by(units.desc(), OrderLine.product_id))
+    if status is not None or since is not None:
+        statement = statement.join(Order, Order.id == OrderLine.order_id)
+        if status is not None:
+            statement = statement.where(Order.status == status)
+        if since is not None:
+            statement = statement.where(Order.date_created >= since)
+    if limit:
+        statement = statement.limit(limit)
+    return db.session.execute(statement).all()
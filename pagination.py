@@ -0,0 +1,39 @@
+class KeysetPage:
+    # A page of rows newest-first, addressed by the key of its first/last row instead of an OFFSET,
+    # so page 500 costs the same index range read as page 1.
+
+    def __init__(self, items, key, has_next, has_prev, total=None):
+        self.items = items
+        self.key = key
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.total = total
+
+    @property
+    def next_cursor(self):
+        return getattr(self.items[-1], self.key) if self.has_next and self.items else None
+
+    @property
+    def prev_cursor(self):
+        return getattr(self.items[0], self.key) if self.has_prev and self.items else None
+
+
+def keyset_query(statement, key, after=None, before=None, per_page=8):
+    # the statement keyset_paginate runs: one row more than per_page, to tell whether another page follows
+    if before is not None:
+        return statement.where(key > before).order_by(key.asc()).limit(per_page + 1)
+    if after is not None:
+        statement = statement.where(key < after)
+    return statement.order_by(key.desc()).limit(per_page + 1)
+
+
+def keyset_paginate(db, statement, key, after=None, before=None, per_page=8, total=None, scalars=True):
+    # statement: an unordered select; key: a unique, indexed column (rows are returned key DESC).
+    # after: cursor from next_cursor, before: cursor from prev_cursor.
+    # scalars=False keeps whole rows (for multi-column selects); key must then be one of the selected columns.
+    fetch = (lambda result: result.scalars().all()) if scalars else (lambda result: result.all())
+    rows = fetch(db.session.execute(keyset_query(statement, key, after, before, per_page)))
+    if before is not None:
+        # walked backwards from the cursor; flip the rows back into display order
+        return KeysetPage(rows[:per_page][::-1], key.key, has_next=True, has_prev=len(rows) > per_page, total=total)
+    return KeysetPage(rows[:per_page], key.key, has_next=len(rows) > per_page, has_prev=after is not None, total=total)
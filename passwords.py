@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+SALT_LENGTH = 16
+
+
+class HashingBusy(Exception):
+    # every hashing process is busy and the queue is full (or the wait ran out); answer 503 and let
+    # the client retry instead of parking a web worker behind the backlog
+    pass
+
+
+class Throttled(Exception):
+    # too many attempts for this account or address; answer 429
+
+    def __init__(self, retry_after):
+        super().__init__("too many attempts, retry in %d seconds" % retry_after)
+        self.retry_after = retry_after
+
+
+def _hash(password, method):
+    return generate_password_hash(password, method=method, salt_length=SALT_LENGTH)
+
+
+def _verify(pwhash, password, method):
+    # (matches, new hash or None); the upgrade is computed in the same trip to the pool
+    if not check_password_hash(pwhash, password):
+        return False, None
+    if needs_rehash(pwhash, method):
+        return True, _hash(password, method)
+    return True, None
+
+
+def needs_rehash(pwhash, method):
+    # werkzeug hashes look like "scrypt:32768:8:1$<salt>$<hash>"; older rows were made with shorter salts
+    # or other cost parameters and are rewritten on the next successful login. method: normalized_method()
+    stored_method, _, rest = pwhash.partition("$")
+    salt = rest.partition("$")[0]
+    return stored_method != method or len(salt) < SALT_LENGTH
+
+
+def normalized_method(method):
+    # the method string werkzeug stores with the hash, defaults filled in: "scrypt" -> "scrypt:32768:8:1"
+    name, *args = method.split(":")
+    if name == "scrypt":
+        n, r, p = map(int, args) if args else (2 ** 15, 8, 1)
+        return "scrypt:%d:%d:%d" % (n, r, p)
+    if name == "pbkdf2":
+        hash_name = args[0] if args else "sha256"
+        iterations = int(args[1]) if len(args) > 1 else DEFAULT_PBKDF2_ITERATIONS
+        return "pbkdf2:%s:%d" % (hash_name, iterations)
+    raise ValueError("unsupported password hash method %r" % method)
+
+
+class PasswordHasher:
+    # Runs scrypt/pbkdf2 in a pool of max_workers processes, so a burst of logins burns those cores
+    # instead of every web worker's request threads. At most max_workers + max_pending hashes are in
+    # flight per web worker; past that hash()/verify() raise HashingBusy at once. max_workers=0 hashes
+    # inline (CLI, tests). The pool's processes are started fresh (forkserver/spawn), which re-imports the
+    # __main__ script: scripts using it need the usual `if __name__ == "__main__":` guard.
+    #
+    # method is werkzeug's: "scrypt:N:r:p" or "pbkdf2:sha256:iterations". Raising it upgrades
+    # each stored hash the next time its owner logs in.
+
+    def __init__(self, method="scrypt:32768:8:1", max_workers=2, max_pending=8, wait_seconds=5):
+        self.method = normalized_method(method)
+        self.max_workers = max_workers
+        self.wait_seconds = wait_seconds
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending) if max_workers else None
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def executor(self):
+        # created on first use in each process: a pool made in the gunicorn master (preload) would be
+        # shared by, and useless to, the forked workers
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                methods = multiprocessing.get_all_start_methods()
+                # the web worker has threads (db pools, payments); don't fork it, fork a clean server instead
+                context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+                self._pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _run(self, function, *args):
+        if not self.max_workers:
+            return function(*args)
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HashingBusy("password hashing is saturated")
+        try:
+            future = self.executor().submit(function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.wait_seconds)
+        except FutureTimeout:
+            # the hash still finishes in the background and frees its slot then
+            raise HashingBusy("password hashing took longer than %s seconds" % self.wait_seconds)
+        except BrokenProcessPool:
+            # a hashing process died (e.g. OOM-killed); start a new pool on the next call
+            with self._lock:
+                self._pool = None
+            raise HashingBusy("the password hashing pool had to be restarted")
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        # (matches, new hash to store or None)
+        return self._run(_verify, pwhash, password, self.method)
+
+    def stats(self):
+        return {"method": self.method, "workers": self.max_workers, "rejected": self.rejected}
+
+
+class LoginThrottle:
+    # Fixed-window counters per worker process, like RequestMetrics: every attempt from an address counts
+    # against per_ip, failed ones also against the account's per_account. Checked before any hashing,
+    # so a credential-stuffing burst is turned away for the price of a dict lookup.
+
+    def __init__(self, per_ip=30, per_account=5, window=300):
+        self.per_ip = per_ip
+        self.per_account = per_account
+        self.window = window
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def _slot(self):
+        now = time.time()
+        return int(now // self.window), int(self.window - now % self.window) + 1
+
+    def check(self, ip, account=None):
+        # counts this attempt for the address; raises Throttled when either limit is used up
+        window, retry_after = self._slot()
+        with self._lock:
+            if len(self._counts) > 100000:
+                self._counts = {key: count for key, count in self._counts.items() if key[0] == window}
+            ip_key = (window, "ip", ip)
+            if self._counts.get(ip_key, 0) >= self.per_ip:
+                raise Throttled(retry_after)
+            if account is not None and self._counts.get((window, "account", account), 0) >= self.per_account:
+                raise Throttled(retry_after)
+            self._counts[ip_key] = self._counts.get(ip_key, 0) + 1
+
+    def failed(self, account):
+        window, _ = self._slot()
+        key = (window, "account", account)
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def succeeded(self, account):
+        window, _ = self._slot()
+        with self._lock:
+            self._counts.pop((window, "account", account), None)
@@ -0,0 +1,172 @@
+import hashlib
+import logging
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from order_lines import lines_from_items, totals_from_lines
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentFailed(Exception):
+    # the charge was refused (declined card, invalid token); retrying with the same card won't help.
+    # The message is shown to the customer.
+    pass
+
+
+class PaymentUnavailable(Exception):
+    # network error, timeout, rate limit or gateway outage; safe to retry with the same idempotency key
+    pass
+
+
+def idempotency_key(invoice, token):
+    # one key per order and card token: a double submit of the same form is charged once,
+    # while paying again with another card after a decline is a new attempt
+    return "order-%s-%s" % (invoice, hashlib.sha256((token or "").encode()).hexdigest()[:16])
+
+
+class StripeGateway:
+
+    def __init__(self, api_key, timeout=10, max_network_retries=2):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.max_network_retries = max_network_retries
+        self._client = None
+
+    def client(self):
+        if self._client is None:
+            import stripe
+            self._client = stripe.StripeClient(self.api_key, max_network_retries=self.max_network_retries,
+                                               http_client=stripe.RequestsClient(timeout=self.timeout))
+        return self._client
+
+    def charge(self, key, email, token, amount, currency, description):
+        import stripe
+        client = self.client()
+        try:
+            customer = client.customers.create(params={"email": email, "source": token},
+                                               options={"idempotency_key": key + "-customer"})
+            charge = client.charges.create(params={"customer": customer.id, "amount": amount, "currency": currency,
+                                                   "description": description},
+                                           options={"idempotency_key": key + "-charge"})
+        except stripe.CardError as error:
+            raise PaymentFailed(error.user_message or "Your card was declined.") from error
+        except (stripe.APIConnectionError, stripe.RateLimitError, stripe.APIError) as error:
+            raise PaymentUnavailable(str(error)) from error
+        except stripe.StripeError as error:
+            raise PaymentFailed("The payment could not be processed.") from error
+        if charge.status != "succeeded":
+            raise PaymentFailed("The payment could not be confirmed.")
+        return charge.id
+
+
+class FakeGateway:
+    # In-process stand-in for load tests and local runs. It waits `latency` seconds per charge, fails
+    # `failure_rate` of them as if the network dropped, declines Stripe's decline test tokens and, like
+    # Stripe, returns the first result again for a repeated idempotency key.
+
+    DECLINED = {"tok_chargeDeclined", "tok_visa_chargeDeclined", "tok_chargeDeclinedInsufficientFunds"}
+
+    def __init__(self, latency=0.2, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.charges = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def charge(self, key, email, token, amount, currency, description):
+        with self._lock:
+            if key in self.charges:
+                return self.charges[key]
+            unavailable = self._random.random() < self.failure_rate
+        time.sleep(self.latency)
+        if unavailable:
+            raise PaymentUnavailable("fake gateway timed out")
+        if not token or token in self.DECLINED:
+            raise PaymentFailed("Your card was declined.")
+        with self._lock:
+            return self.charges.setdefault(key, "ch_fake_" + uuid.uuid4().hex[:24])
+
+
+class PaymentProcessor:
+    # Charges run on a small thread pool so a slow gateway doesn't hold a web worker; the request waits
+    # a bounded time for the result and otherwise tells the customer it's in progress. Transient errors
+    # are retried with backoff under the same idempotency key. The order only becomes "paid" after the
+    # gateway confirmed the charge, with a conditional UPDATE so two workers can't both record it.
+
+    def __init__(self, db, Order, gateway, sales=None, max_workers=4, attempts=3, backoff=0.5,
+                 currency="usd", description="Shoppers order"):
+        self.db = db
+        self.Order = Order
+        self.gateway = gateway
+        self.sales = sales  # SalesRollups, moved from pending to paid with the status
+        self.attempts = attempts
+        self.backoff = backoff
+        self.currency = currency
+        self.description = description
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="payment")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, invoice, email, token):
+        # one charge per order at a time in this process; a second submit while it runs shares the future
+        with self._lock:
+            future = self._pending.get(invoice)
+            if future is None:
+                # the pool thread needs the app of the request that submitted it for its own app context
+                future = self._pool.submit(self._process, current_app._get_current_object(), invoice, email, token)
+                self._pending[invoice] = future
+                future.add_done_callback(lambda done: self._forget(invoice))
+            return future
+
+    def _forget(self, invoice):
+        with self._lock:
+            self._pending.pop(invoice, None)
+
+    def _process(self, app, invoice, email, token):
+        Order = self.Order
+        with app.app_context():
+            order = self.db.session.execute(self.db.select(Order.status, Order.total).where(Order.invoice == invoice)).first()
+            totals = {}
+            if order is not None and order.total is None:
+                # placed before totals were stored and not backfilled yet: priced from its json cart, as the
+                # order page shows it, and stored along with the status
+                items = self.db.session.execute(self.db.select(Order.items).where(Order.invoice == invoice)).scalar()
+                amount, tax, total = totals_from_lines(lines_from_items(items or {}))
+                totals = {"amount": amount, "tax": tax, "total": total}
+            # don't keep a pooled connection checked out while waiting on the gateway
+            self.db.session.close()
+            if order is None:
+                raise PaymentFailed("Unknown order.")
+            if order.status == "paid":
+                return None
+            total = totals.get("total", order.total)
+            if total <= 0:
+                raise PaymentFailed("This order has nothing to pay.")
+
+            charge_id = self._charge(idempotency_key(invoice, token), email, token, int(total * 100))
+
+            result = self.db.session.execute(
+                self.db.update(Order).where(Order.invoice == invoice, Order.status != "paid")
+                .values(status="paid", **totals).execution_options(synchronize_session=False))
+            if result.rowcount and self.sales is not None:
+                paid = self.db.session.execute(self.db.select(Order).where(Order.invoice == invoice)).scalar()
+                self.sales.record_payment(paid, order.status)
+            self.db.session.commit()
+            logger.info("order %s paid with charge %s", invoice, charge_id)
+            return charge_id
+
+    def _charge(self, key, email, token, amount):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return self.gateway.charge(key, email, token, amount, self.currency, self.description)
+            except PaymentUnavailable:
+                if attempt == self.attempts:
+                    raise
+                logger.warning("payment %s: gateway unavailable, retry %d of %d", key, attempt, self.attempts - 1)
+                time.sleep(self.backoff * 2 ** (attempt - 1))
@@ -0,0 +1,40 @@
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+TAX_RATE = Decimal("0.05")  # 5% tax
+CENT = Decimal("0.01")
+
+# amount: sum of discounted line totals, lines: {item key: discounted line total}
+Totals = namedtuple("Totals", ["amount", "tax", "total", "lines"])
+
+
+def to_cents(value):
+    return value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def line_total(price, quantity, discount):
+    gross = Decimal(price if isinstance(price, str) else str(price)) * int(quantity)
+    if discount:
+        gross -= gross * int(discount) / 100
+    return gross.quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def price_items(items):
+    # items in the cart / Order.items shape: {key: {"price", "quantity", "discount", ...}}
+    lines = {}
+    amount = Decimal(0)
+    for key, value in items.items():
+        lines[key] = line_total(value["price"], value["quantity"], value["discount"])
+        amount += lines[key]
+    tax = to_cents(amount * TAX_RATE)
+    return Totals(amount, tax, amount + tax, lines)
+
+
+def order_totals(order, lines):
+    # lines: the order's OrderLine rows; orders placed before totals were persisted are summed from them
+    line_totals = {str(line.product_id): line.line_total for line in lines}
+    if order.total is not None:
+        return Totals(order.amount, order.tax, order.total, line_totals)
+    amount = sum(line_totals.values(), Decimal(0))
+    tax = to_cents(amount * TAX_RATE)
+    return Totals(amount, tax, amount + tax, line_totals)
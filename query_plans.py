@@ -0,0 +1,42 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# "SCAN product" walks the whole table. "SCAN product USING INDEX ..." is accepted: it is how sqlite reads a
+# partial index or stops early on ORDER BY ... LIMIT, unless it then has to sort everything it read.
+SQLITE_FULL_SCAN = re.compile(r"^SCAN (\w+)\b(?! USING)|^(USE TEMP B-TREE) FOR ORDER BY")
+POSTGRES_FULL_SCAN = re.compile(r"Seq Scan on (\w+)")
+
+
+def explain(db, statement):
+    dialect = db.engine.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+    connection = db.session.connection()
+    if dialect.name == "sqlite":
+        return [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+    if dialect.name == "postgresql":
+        # tiny tables always win with a seq scan; ask whether an index path exists at all
+        connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        return [row[0] for row in connection.exec_driver_sql("EXPLAIN " + sql)]
+    # no plan parser for this database: report nothing rather than fail every statement
+    logger.warning("query plans are only checked on sqlite and postgresql, not %s", dialect.name)
+    return []
+
+
+def full_scans(db, plan):
+    pattern = SQLITE_FULL_SCAN if db.engine.dialect.name == "sqlite" else POSTGRES_FULL_SCAN
+    return [match.group(match.lastindex) for match in (pattern.search(line.strip()) for line in plan) if match]
+
+
+def check(db, statements):
+    # statements: {name: select/update}; returns {name: plan} for every one that scans a whole table
+    failures = {}
+    try:
+        for name, statement in statements.items():
+            plan = explain(db, statement)
+            if full_scans(db, plan):
+                failures[name] = plan
+    finally:
+        db.session.rollback()
+    return failures
@@ -0,0 +1,30 @@
+from sqlalchemy import inspect, text
+
+# indexes no longer declared on the models, dropped from databases that still have them: {table: names}
+DROPPED_INDEXES = {
+    "order": ("ix_order_customer_invoice",),  # the unique invoice index already serves those lookups
+}
+
+
+def upgrade(db):
+    # create_all only creates missing tables; this also adds columns and indexes that were
+    # declared on the models after an existing database was created. New columns must be nullable.
+    db.create_all()
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text("ALTER TABLE %s ADD COLUMN %s %s" % (
+                        preparer.format_table(table), preparer.quote(column.name),
+                        column.type.compile(dialect=db.engine.dialect))))
+
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+            for name in DROPPED_INDEXES.get(table.name, ()):
+                if name in indexes:
+                    conn.execute(text("DROP INDEX %s" % preparer.quote(name)))
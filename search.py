@@ -0,0 +1,169 @@
+import math
+import re
+
+from sqlalchemy import text
+
+
+class SearchPage:
+    # same attributes the templates already use on flask_sqlalchemy's Pagination
+
+    def __init__(self, items, total, page, per_page):
+        self.items = items
+        self.total = total
+        self.page = page
+        self.per_page = per_page
+
+    @property
+    def pages(self):
+        return max(1, math.ceil(self.total / self.per_page))
+
+    @property
+    def has_prev(self):
+        return self.page > 1
+
+    @property
+    def has_next(self):
+        return self.page < self.pages
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+
+class ProductSearch:
+    # Full-text index over Product.name/description.
+    # sqlite: FTS5 table product_fts keyed by rowid == product.id
+    # postgresql: product_search table holding a weighted tsvector with a GIN index
+    # anything else falls back to the old LIKE scan.
+
+    def __init__(self, db, product_model):
+        self.db = db
+        self.Product = product_model
+
+    @property
+    def dialect(self):
+        return self.db.engine.dialect.name
+
+    def ensure_index(self):
+        if self.dialect == "sqlite":
+            exists = self.db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='product_fts'")).scalar()
+            if not exists:
+                self.db.session.execute(text(
+                    "CREATE VIRTUAL TABLE product_fts USING fts5(name, description, tokenize='unicode61')"))
+        elif self.dialect == "postgresql":
+            exists = self.db.session.execute(text("SELECT to_regclass('product_search')")).scalar()
+            if not exists:
+                self.db.session.execute(text(
+                    "CREATE TABLE product_search ("
+                    "product_id INTEGER PRIMARY KEY REFERENCES product(id) ON DELETE CASCADE, "
+                    "document TSVECTOR NOT NULL)"))
+                self.db.session.execute(text(
+                    "CREATE INDEX ix_product_search_document ON product_search USING GIN (document)"))
+        else:
+            return
+        self.db.session.commit()
+        if not exists:
+            # first start after upgrading: fill the new index from the existing catalog
+            self.reindex()
+
+    def index_product(self, product):
+        # call after flush so the product has an id; the caller commits
+        if self.dialect == "sqlite":
+            self.db.session.execute(text("DELETE FROM product_fts WHERE rowid=:id"), {"id": product.id})
+            self.db.session.execute(text(
+                "INSERT INTO product_fts(rowid, name, description) VALUES (:id, :name, :description)"),
+                {"id": product.id, "name": product.name, "description": product.description})
+        elif self.dialect == "postgresql":
+            self.db.session.execute(text(
+                "INSERT INTO product_search(product_id, document) VALUES (:id, "
+                "setweight(to_tsvector('english', :name), 'A') || setweight(to_tsvector('english', :description), 'B')) "
+                "ON CONFLICT (product_id) DO UPDATE SET document=EXCLUDED.document"),
+                {"id": product.id, "name": product.name, "description": product.description})
+
+    def index_many(self, products):
+        # products: rows/objects with id, name and description; one executemany instead of a statement each
+        insert = self._insert_statement()
+        if insert is not None and products:
+            self.db.session.execute(insert, [{"id": p.id, "name": p.name, "description": p.description} for p in products])
+
+    def _insert_statement(self):
+        if self.dialect == "sqlite":
+            return text("INSERT INTO product_fts(rowid, name, description) VALUES (:id, :name, :description)")
+        if self.dialect == "postgresql":
+            return text(
+                "INSERT INTO product_search(product_id, document) VALUES (:id, "
+                "setweight(to_tsvector('english', :name), 'A') || setweight(to_tsvector('english', :description), 'B'))")
+        return None
+
+    def remove_product(self, product_id):
+        if self.dialect == "sqlite":
+            self.db.session.execute(text("DELETE FROM product_fts WHERE rowid=:id"), {"id": product_id})
+        elif self.dialect == "postgresql":
+            self.db.session.execute(text("DELETE FROM product_search WHERE product_id=:id"), {"id": product_id})
+
+    def reindex(self, batch_size=500):
+        if self.dialect == "sqlite":
+            self.db.session.execute(text("DELETE FROM product_fts"))
+        elif self.dialect == "postgresql":
+            self.db.session.execute(text("DELETE FROM product_search"))
+        else:
+            return 0
+
+        Product = self.Product
+        count = 0
+        last_id = 0
+        while True:
+            rows = self.db.session.execute(
+                self.db.select(Product.id, Product.name, Product.description)
+                .where(Product.id > last_id).order_by(Product.id).limit(batch_size)).all()
+            if not rows:
+                break
+            self.index_many(rows)
+            count += len(rows)
+            last_id = rows[-1].id
+        self.db.session.commit()
+        return count
+
+    def search(self, keyword, page=1, per_page=8):
+        keyword = (keyword or "").strip()
+        page = max(page, 1)
+        terms = re.findall(r"\w+", keyword)
+        if not terms:
+            return SearchPage([], 0, page, per_page)
+
+        offset = (page - 1) * per_page
+        if self.dialect == "sqlite":
+            # every term quoted so user input can't inject FTS5 operators; prefix match keeps "sho" finding "shoes"
+            query = " ".join('"%s"*' % t for t in terms)
+            params = {"q": query, "limit": per_page, "offset": offset}
+            total = self.db.session.execute(
+                text("SELECT count(*) FROM product_fts WHERE product_fts MATCH :q"), params).scalar()
+            ids = self.db.session.execute(text(
+                "SELECT rowid FROM product_fts WHERE product_fts MATCH :q "
+                "ORDER BY bm25(product_fts, 10.0, 1.0) LIMIT :limit OFFSET :offset"), params).scalars().all()
+        elif self.dialect == "postgresql":
+            query = " & ".join("%s:*" % t for t in terms)
+            params = {"q": query, "limit": per_page, "offset": offset}
+            total = self.db.session.execute(text(
+                "SELECT count(*) FROM product_search WHERE document @@ to_tsquery('english', :q)"), params).scalar()
+            ids = self.db.session.execute(text(
+                "SELECT product_id FROM product_search WHERE document @@ to_tsquery('english', :q) "
+                "ORDER BY ts_rank(document, to_tsquery('english', :q)) DESC, product_id DESC "
+                "LIMIT :limit OFFSET :offset"), params).scalars().all()
+        else:
+            Product = self.Product
+            condition = Product.name.like("%" + keyword + "%") | Product.description.like("%" + keyword + "%")
+            total = self.db.session.execute(self.db.select(self.db.func.count()).select_from(Product).where(condition)).scalar()
+            ids = self.db.session.execute(self.db.select(Product.id).where(condition).order_by(Product.id.desc())
+                                          .limit(per_page).offset(offset)).scalars().all()
+
+        if not ids:
+            return SearchPage([], total, page, per_page)
+        products = self.db.session.execute(self.db.select(self.Product).where(self.Product.id.in_(ids))).scalars().all()
+        by_id = {p.id: p for p in products}
+        return SearchPage([by_id[i] for i in ids if i in by_id], total, page, per_page)
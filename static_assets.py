@@ -0,0 +1,119 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:  # optional; without it only .gz siblings are written
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_DIR = "dist"
+# folders under static/ that are fingerprinted. Uploaded images are left alone: ImagePipeline already
+# names them by content.
+SOURCE_DIRS = ("css", "js", "images")
+SKIP_DIRS = ("images/products", "images/profile_pic")
+# already-compressed formats (jpg, png, webp, ...) only get fingerprinted
+COMPRESSIBLE = (".css", ".js", ".svg", ".json", ".txt", ".map")
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def build(static_folder):
+    # copies every asset to dist/<name>.<hash>.<ext>, writes .gz/.br siblings for text files and a
+    # manifest {"css/styles.css": "css/styles.<hash>.css"}. Older builds are kept: pages cached in
+    # browsers may still point at them.
+    output = os.path.join(static_folder, OUTPUT_DIR)
+    manifest = {}
+    for source_dir in SOURCE_DIRS:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(static_folder, source_dir)):
+            relative_dir = os.path.relpath(dirpath, static_folder).replace(os.sep, "/")
+            dirnames[:] = [d for d in dirnames if relative_dir + "/" + d not in SKIP_DIRS]
+            for filename in sorted(filenames):
+                name = relative_dir + "/" + filename
+                with open(os.path.join(dirpath, filename), "rb") as source:
+                    data = source.read()
+                stem, ext = os.path.splitext(name)
+                hashed = "%s.%s%s" % (stem, hashlib.sha256(data).hexdigest()[:12], ext)
+                target = os.path.join(output, hashed)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                _write(target, data)
+                if ext.lower() in COMPRESSIBLE:
+                    _write(target + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+                    if brotli is not None:
+                        _write(target + ".br", brotli.compress(data, quality=11))
+                manifest[name] = hashed
+    if brotli is None:
+        logger.warning("brotli is not installed; only gzip copies were written")
+    _write(os.path.join(output, "manifest.json"), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+def _write(path, data):
+    with open(path + ".tmp", "wb") as out:
+        out.write(data)
+    os.replace(path + ".tmp", path)
+
+
+class StaticAssets:
+    # Serves the output of build(): asset_url() has url_for's signature and turns
+    # url_for("static", filename="css/styles.css") into /static/dist/css/styles.<hash>.css, which is
+    # cached for a year as immutable. Requests for those files get the .br or .gz sibling when the
+    # browser accepts it. Without a build (e.g. in development) asset_url() is plain url_for.
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.load()
+        app.add_template_global(self.asset_url)
+        app.before_request(self._serve_precompressed)
+        app.after_request(self._cache_headers)
+
+    def load(self):
+        path = os.path.join(self.app.static_folder, OUTPUT_DIR, "manifest.json")
+        try:
+            with open(path) as manifest:
+                self.manifest = json.load(manifest)
+        except FileNotFoundError:
+            self.manifest = {}
+        return self.manifest
+
+    def asset_url(self, endpoint, **values):
+        if endpoint == "static" and values.get("filename") in self.manifest:
+            values["filename"] = OUTPUT_DIR + "/" + self.manifest[values["filename"]]
+        return url_for(endpoint, **values)
+
+    def _is_built(self):
+        return request.endpoint == "static" and (request.view_args or {}).get("filename", "").startswith(OUTPUT_DIR + "/")
+
+    def _serve_precompressed(self):
+        if not self._is_built():
+            return None
+        filename = request.view_args["filename"]
+        directory = self.app.static_folder
+        for encoding, suffix in ENCODINGS:
+            if request.accept_encodings[encoding] and os.path.isfile(os.path.join(directory, filename + suffix)):
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                response = send_from_directory(directory, filename + suffix, mimetype=mimetype, max_age=31536000)
+                response.headers["Content-Encoding"] = encoding
+                return response
+        return None
+
+    def _cache_headers(self, response):
+        if self._is_built() and response.status_code in (200, 304):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = 31536000
+            response.cache_control.immutable = True
+            response.vary.add("Accept-Encoding")
+        return response
+